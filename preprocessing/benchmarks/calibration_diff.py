@@ -0,0 +1,138 @@
+"""
+Runs the original OWLET calibration (calibration_og.py) and the refactored one (calibration.py) on the same
+calibration videos, diffs every calibration parameter they return and reports the time each of them takes.
+The refactor can replace the original once all parameters match.
+
+Run from the preprocessing directory:
+
+    python -m benchmarks.calibration_diff [--videos 10] [--tolerance 1e-9] [--out calibration_diff.csv]
+"""
+
+import os
+import csv
+import glob
+import time
+import argparse
+
+import settings
+from src.owlet_slim import calibration, calibration_og
+
+# name of the parameter (as stored by OWLET.calibrate_gaze) and how to get it from either implementation
+PARAMETERS = [
+    (('min_xval', 'max_xval', 'range_xvals', 'middle_x'),
+     lambda c: c.get_min_max_hor(), lambda c: c.get_min_max_hor(1)),
+    (('min_xval2', 'max_xval2', 'range_xvals2', 'middle_x2'),
+     lambda c: c.get_min_max_hor2(), lambda c: c.get_min_max_hor(2)),
+    (('min_yval', 'max_yval', 'range_yvals', 'middle_y', 'range_yvals_left', 'range_yvals_right',
+      'min_yval_left', 'min_yval_right'),
+     lambda c: c.get_min_max_ver(), lambda c: c.get_min_max_ver()),
+    (('mean', 'maximum', 'minimum'),
+     lambda c: c.get_eye_ratio(), lambda c: c.get_eye_ratio()),
+    (('eyearea',),
+     lambda c: (c.get_eye_area(),), lambda c: (c.get_eye_area(),)),
+    (('mean_eyeratio', 'maxeyeratio', 'mineyeratio'),
+     lambda c: c.get_eye_area_ratio(), lambda c: c.get_eye_area_ratio()),
+    (('length',),
+     lambda c: (c.get_avg_length(),), lambda c: (c.get_avg_length(),)),
+]
+
+# samples collected during calibration, the parameters are computed from these
+SAMPLE_LISTS = ['hor_ratios', 'hor_ratios2', 'ver_ratios', 'ver_ratios_left', 'ver_ratios_right', 'blinks', 'areas',
+                'eye_areas']
+
+
+def count_analysed_frames(calib):
+    refresh = calib.gaze.refresh
+    calib.analysed_frames = 0
+
+    def counted_refresh(frame):
+        calib.analysed_frames += 1
+        refresh(frame)
+    calib.gaze.refresh = counted_refresh
+
+
+def run_calibration(calib, calibrate, implementation):
+    """
+    Returns the calibration parameters (None where a getter fails), the sample counts, the runtime and the number
+    of analysed frames. implementation is 0 for calibration_og and 1 for calibration.
+    """
+    count_analysed_frames(calib)
+    start = time.perf_counter()
+    calibrate()
+    elapsed = time.perf_counter() - start
+
+    values = dict()
+    for names, *getters in PARAMETERS:
+        try:
+            result = getters[implementation](calib)
+        except Exception:  # the getters fail on empty sample lists, e.g. if no face was found
+            result = [None] * len(names)
+        values.update(zip(names, result))
+
+    samples = {name: len(getattr(calib, name)) for name in SAMPLE_LISTS}
+    return values, samples, elapsed, calib.analysed_frames
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--videos', type=int, default=10, help='number of calibration videos to compare')
+    parser.add_argument('--tolerance', type=float, default=1e-9, help='maximum absolute difference counted as a match')
+    parser.add_argument('--out', help='optional csv file for the per-video differences')
+    args = parser.parse_args()
+
+    video_dir, crop = (settings.WEBCAM_MP4_DIR, (16, 9)) if settings.OWLET_CROP_ON_THE_FLY \
+        else (settings.CROPPED_WEBCAM_MP4_DIR, None)
+    video_paths = sorted(glob.glob(os.path.join(video_dir, '*_calibration.mp4')))[:args.videos]
+    if len(video_paths) == 0:
+        exit(f'No calibration videos found in {video_dir}, run step 1 of the pipeline first')
+
+    rows = []
+    timings = {'calibration_og': [0.0, 0], 'calibration': [0.0, 0]}
+    for path in video_paths:
+        print(f'Calibrating {os.path.basename(path)}')
+
+        og = calibration_og.LookingCalibration(False, os.getcwd(), settings.OWLET_FACE_DETECTOR)
+        og_values, og_samples, og_time, og_frames = run_calibration(
+            og, lambda: og.calibrate_eyes(path, 0, crop=crop, decoder=settings.OWLET_DECODER), 0)
+
+        refactor = calibration.LookingCalibration(False, settings.OWLET_FACE_DETECTOR)
+        values, samples, refactor_time, refactor_frames = run_calibration(
+            refactor, lambda: refactor.calibrate_eyes(path, crop=crop, decoder=settings.OWLET_DECODER), 1)
+
+        timings['calibration_og'][0] += og_time
+        timings['calibration_og'][1] += og_frames
+        timings['calibration'][0] += refactor_time
+        timings['calibration'][1] += refactor_frames
+
+        for name in og_values:
+            a, b = og_values[name], values[name]
+            diff = abs(a - b) if a is not None and b is not None else None
+            rows.append({'video': os.path.basename(path), 'kind': 'parameter', 'name': name,
+                         'calibration_og': a, 'calibration': b, 'abs_diff': diff})
+        for name in SAMPLE_LISTS:
+            rows.append({'video': os.path.basename(path), 'kind': 'samples', 'name': name,
+                         'calibration_og': og_samples[name], 'calibration': samples[name],
+                         'abs_diff': abs(og_samples[name] - samples[name])})
+
+    print(f'\n{"parameter":<20}{"matching videos":>16}{"max abs diff":>16}')
+    for names, *_ in PARAMETERS:
+        for name in names:
+            param_rows = [r for r in rows if r['kind'] == 'parameter' and r['name'] == name]
+            matching = sum(r['abs_diff'] is not None and r['abs_diff'] <= args.tolerance or
+                           r['calibration_og'] is None and r['calibration'] is None for r in param_rows)
+            diffs = [r['abs_diff'] for r in param_rows if r['abs_diff'] is not None]
+            print(f'{name:<20}{f"{matching}/{len(param_rows)}":>16}{(max(diffs) if diffs else float("nan")):>16.6g}')
+
+    print(f'\n{"implementation":<20}{"seconds":>10}{"analysed frames":>18}{"frames/s":>10}')
+    for implementation, (elapsed, frames) in timings.items():
+        print(f'{implementation:<20}{elapsed:>10.1f}{frames:>18}{frames / elapsed if elapsed > 0 else 0:>10.1f}')
+
+    if args.out:
+        with open(args.out, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
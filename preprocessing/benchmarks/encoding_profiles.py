@@ -0,0 +1,76 @@
+"""
+Encodes the same webcam recordings with every encoding profile (ENCODING_PROFILES in settings.py) the way step 1
+transcodes them and reports the encode time and the size of the results per profile. The "default" row encodes
+without any output options, i.e. with ffmpeg's defaults like the pipeline did before the profiles, as the baseline.
+
+Run from the preprocessing directory:
+
+    python -m benchmarks.encoding_profiles [--videos 10] [--profiles analysis review] [--keep]
+"""
+
+import os
+import glob
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import settings
+from src import encoding
+
+# baseline row, encoded with ffmpeg's default output options
+BASELINE = 'default'
+
+
+def encode(input_path, output_path, profile):
+    start = time.perf_counter()
+    subprocess.run(['ffmpeg', '-y', '-v', 'error',
+                    '-i', input_path,
+                    '-filter:v',
+                    f'fps={settings.TARGET_FPS}',
+                    ] + ([] if profile == BASELINE else encoding.output_args(profile)) + [
+                    output_path,
+                    ], check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--video-dir', default=settings.DATA_DIR, help='directory of the webm recordings')
+    parser.add_argument('--videos', type=int, default=10, help='number of recordings to encode')
+    parser.add_argument('--profiles', nargs='+', default=list(settings.ENCODING_PROFILES.keys()),
+                        choices=list(settings.ENCODING_PROFILES.keys()))
+    parser.add_argument('--keep', action='store_true', help='keep the encoded videos for inspection')
+    args = parser.parse_args()
+
+    video_paths = sorted(glob.glob(os.path.join(args.video_dir, '*.webm')))[:args.videos]
+    if len(video_paths) == 0:
+        exit(f'No webm recordings found in {args.video_dir}')
+
+    output_dir = tempfile.mkdtemp(prefix='encoding_profiles_')
+    input_size = sum(os.path.getsize(path) for path in video_paths)
+    results = {profile: [0.0, 0] for profile in [BASELINE] + args.profiles}
+    for path in video_paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        print(f'Encoding {name}')
+        for profile in results:
+            output_path = os.path.join(output_dir, f'{name}_{profile}.mp4')
+            results[profile][0] += encode(path, output_path, profile)
+            results[profile][1] += os.path.getsize(output_path)
+
+    print(f'\n{len(video_paths)} recordings, {input_size / 1e6:.1f} MB')
+    print(f'{"profile":<12}{"seconds":>10}{"MB":>10}{"size ratio":>12}{"time vs default":>17}{"size vs default":>17}')
+    baseline_elapsed, baseline_size = results[BASELINE]
+    for profile, (elapsed, size) in results.items():
+        print(f'{profile:<12}{elapsed:>10.1f}{size / 1e6:>10.1f}{size / input_size:>12.2f}'
+              f'{elapsed / baseline_elapsed:>17.2f}{size / baseline_size:>17.2f}')
+
+    if args.keep:
+        print(f'\nThe encoded videos are in {output_dir}')
+    else:
+        shutil.rmtree(output_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Compares the face detector backends of OWLET on recorded webcam frames: throughput of each backend and how well its
+detections agree with dlib's HOG detector (the detector of the original OWLET).
+
+Frames are sampled evenly from the webcam videos created in step 1, cropped and scaled the same way OWLET does it.
+Run from the preprocessing directory:
+
+    python -m benchmarks.face_detectors [--videos 20] [--frames 30] [--detectors dlib_hog opencv_dnn haar]
+"""
+
+import os
+import glob
+import time
+import argparse
+
+import settings
+from src.owlet_slim.video import open_video
+from src.owlet_slim.face_detectors import DETECTORS, create_face_detector, select_face
+
+REFERENCE = 'dlib_hog'
+
+
+def sample_frames(video_path, n_frames):
+    """Returns n_frames grayscale frames evenly spread over the video, decoded with settings.OWLET_DECODER"""
+    video = open_video(video_path, settings.OWLET_DECODER, crop=(16, 9), gray=True)
+    total = video.frame_count()
+    wanted = set(int(i * total / n_frames) for i in range(n_frames))
+
+    frames = []
+    for i in range(total):
+        if i not in wanted:
+            if not video.grab():
+                break
+            continue
+        success, frame = video.read()
+        if not success:
+            break
+        frames.append(frame.copy())  # the reader reuses its frame buffer
+    video.release()
+    return frames
+
+
+def iou(a, b):
+    overlap = a.intersect(b).area()  # 0 for disjoint rectangles
+    return overlap / (a.area() + b.area() - overlap)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--video-dir', default=settings.WEBCAM_MP4_DIR)
+    parser.add_argument('--videos', type=int, default=20, help='number of videos to sample frames from')
+    parser.add_argument('--frames', type=int, default=30, help='number of frames per video')
+    parser.add_argument('--detectors', nargs='+', default=list(DETECTORS.keys()), choices=list(DETECTORS.keys()))
+    args = parser.parse_args()
+
+    video_paths = sorted(glob.glob(os.path.join(args.video_dir, '*.mp4')))[:args.videos]
+    if len(video_paths) == 0:
+        exit(f'No videos found in {args.video_dir}, run step 1 of the pipeline first')
+
+    frames = [frame for path in video_paths for frame in sample_frames(path, args.frames)]
+    print(f'{len(frames)} frames from {len(video_paths)} videos\n')
+
+    detectors = [REFERENCE] + [d for d in args.detectors if d != REFERENCE]
+    faces = dict()
+    print(f'{"detector":<12}{"frames/s":>10}{"detected":>10}{"presence agreement":>20}{"IoU >= 0.5":>12}')
+    for name in detectors:
+        detector = create_face_detector(name)
+        detector(frames[0])  # warm up
+
+        start = time.perf_counter()
+        faces[name] = [detector(frame) for frame in frames]
+        fps = len(frames) / (time.perf_counter() - start)
+
+        detected = [len(f) > 0 for f in faces[name]]
+        reference = [len(f) > 0 for f in faces[REFERENCE]]
+        agreement = sum(d == r for d, r in zip(detected, reference)) / len(frames)
+
+        # compare the face OWLET would actually track in frames where both detectors found one
+        both = [(f, r) for f, r in zip(faces[name], faces[REFERENCE]) if len(f) > 0 and len(r) > 0]
+        overlapping = sum(iou(f[select_face(f)], r[select_face(r)]) >= 0.5 for f, r in both)
+
+        print(f'{name:<12}{fps:>10.1f}{sum(detected) / len(frames):>10.1%}{agreement:>20.1%}'
+              f'{(overlapping / len(both)) if both else float("nan"):>12.1%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Measures how long it takes to import the modules of the preprocessing pipeline in a fresh interpreter,
+and how long the CLI takes to start up.
+
+Run from the preprocessing directory:
+
+    python -m benchmarks.import_time
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+PREPROCESSING_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = [
+    'settings',
+    'main',
+    'src.utils',
+    'src.webgazer_handler',
+    'src.icatcher_handler',
+    'src.owlet_handler',
+    'src.owlet_slim.owlet',
+]
+
+REPETITIONS = 5
+
+
+def cumulative_import_time(module):
+    """Returns the cumulative import time of a module in ms, as reported by python -X importtime"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=PREPROCESSING_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        return None
+
+    # format: "import time: self [us] | cumulative | imported package"
+    for line in reversed(result.stderr.splitlines()):
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1000
+    return None
+
+
+def startup_time(args):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, 'main.py'] + args, cwd=PREPROCESSING_DIR,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    print(f'{"module":<28}{"import time (ms, median of " + str(REPETITIONS) + ")":>40}')
+    for module in MODULES:
+        times = sorted(t for t in (cumulative_import_time(module) for _ in range(REPETITIONS)) if t is not None)
+        print(f'{module:<28}{("%.1f" % times[len(times) // 2]) if times else "import failed":>40}')
+
+    times = sorted(startup_time(['--help']) for _ in range(REPETITIONS))
+    print(f'\n{"main.py --help":<28}{"%.1f" % times[len(times) // 2]:>40}')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,15 +3,17 @@ from os.path import isfile, join
 import subprocess
 import shutil
 import argparse
-import json
 
 import pandas as pd
 
 import settings
 from src import utils
-from src.icatcher_handler import ICatcherHandler
-from src.webgazer_handler import WebGazerHandler
-from src.owlet_handler import OWLETHandler
+from src import shards
+from src import job_queue
+from src import telemetry
+from src import cost_model
+from src import encoding
+from src.participant_index import ParticipantDataIndex
 
 
 # TODO:
@@ -31,15 +33,47 @@ def main():
                         help="specify step when preprocessing with exclusions",
                         type=int, choices=[1, 2, 3]
                         )
+    parser.add_argument("--shard",
+                        help="only process the participants of shard i out of N (e.g. 2/4), "
+                             "combine the results of all shards with --merge afterwards",
+                        type=shards.parse_shard
+                        )
+    parser.add_argument("--merge",
+                        help="combine the results of all shards into the layout of a single run",
+                        action="store_true"
+                        )
+    parser.add_argument("--enqueue",
+                        help="fill the job queue with the transcode and tracker jobs of all trials, "
+                             "process them with main.py --worker afterwards",
+                        action="store_true"
+                        )
+    parser.add_argument("--worker",
+                        help="process jobs from the job queue until it is drained, "
+                             "any number of workers can run at once, also on several hosts",
+                        action="store_true"
+                        )
+    parser.add_argument("--inspect",
+                        help="after step 2, render the trials marked with an x in the inspect column of the "
+                             "tracker exclusion files in full quality",
+                        action="store_true"
+                        )
     args = parser.parse_args()
 
-    participants = set()
-    general_exclusions = None
-    exclusion_path = os.path.join(settings.EXCLUSION_DIR, '_exclusions_general.csv')
-
     if not os.path.exists(settings.EXCLUSION_DIR):
         os.makedirs(settings.EXCLUSION_DIR)
 
+    if args.merge:
+        merge()
+        return
+
+    if args.shard:
+        shards.apply_shard(args.shard)
+
+    participants = set()
+    general_exclusions = None
+    # the general exclusions are read from the merged file if there is one, but sharded runs write their own
+    exclusion_path = shards.exclusion_file('_exclusions_general.csv')
+
     if (not args.step and not os.path.isfile(exclusion_path)) or (args.step and args.step == 1):
         participants = get_participants()
     elif not os.path.isfile(exclusion_path):
@@ -51,6 +85,19 @@ def main():
     else:
         exit("Should not happen")
 
+    if args.shard:
+        participants = shards.shard_participants(participants, args.shard)
+        if general_exclusions is not None:
+            general_exclusions = general_exclusions[general_exclusions['id'].isin(participants)].reset_index(drop=True)
+
+    if args.enqueue:
+        enqueue(participants, general_exclusions)
+        return
+
+    if args.worker:
+        work(participants, general_exclusions)
+        return
+
     prepare_data(participants, settings.RENDER_WEBCAM_VIDEOS)
 
     if args.step and args.step == 1:
@@ -59,20 +106,101 @@ def main():
                  f'To make sure that you are not accidentally overwriting it, please remove it first.')
 
         exclusion_df = utils.create_empty_general_exclusion_df(participants)
-        exclusion_df.to_csv(exclusion_path, encoding='utf-8', index=False)
+        exclusion_df.to_csv(os.path.join(settings.RESULTS_EXCLUSION_DIR, '_exclusions_general.csv'), encoding='utf-8', index=False)
         return
 
+    for handler, should_render in create_handlers(participants, general_exclusions):
+        if args.inspect:
+            if should_render:
+                handler.render_inspections()
+            continue
+        handler.run(step=args.step, should_render=should_render)
+
+
+def create_handlers(participants, general_exclusions):
+    """Returns the handlers of all trackers in the order they run, together with their render setting"""
+
+    # the tracker modules pull in cv2, dlib and the ICatcher tool chain, so they only get imported when needed
+    from src.icatcher_handler import ICatcherHandler
+    from src.webgazer_handler import WebGazerHandler
+    from src.owlet_handler import OWLETHandler
+
     icatcher = ICatcherHandler(settings.GAZECODER_NAMES['ICATCHER'], participants, general_exclusions)
     webgazer = WebGazerHandler(settings.GAZECODER_NAMES['WEBGAZER'], participants, general_exclusions, dot_color=(255, 0, 0))
     #owlet_nocalib = OWLETHandler(settings.GAZECODER_NAMES['OWLET_NOCALIB'], participants, general_exclusions, dot_color=(125, 255, 0), calibrate=False)
     #owlet = OWLETHandler(settings.GAZECODER_NAMES['OWLET'], participants, general_exclusions, dot_color=(0, 0, 0), calibrate=True)
 
-    #owlet_nocalib.run(step=args.step, should_render=settings.RENDER_OWLET_NOCALIB)
-    #owlet.run(step=args.step, should_render=settings.RENDER_OWLET)
-    icatcher.run(step=args.step, should_render=settings.RENDER_ICATCHER)
-    webgazer.run(step=args.step, should_render=settings.RENDER_WEBGAZER)
+    return [
+        #(owlet_nocalib, settings.RENDER_OWLET_NOCALIB),
+        #(owlet, settings.RENDER_OWLET),
+        (icatcher, settings.RENDER_ICATCHER),
+        (webgazer, settings.RENDER_WEBGAZER),
+    ]
+
+
+def merge():
+    """Combines the outputs of all shards (main.py --shard) into the layout of a single run"""
+    if len(shards.shard_names(settings.OUT_DIR)) == 0:
+        exit(f'No shards found in {os.path.join(settings.OUT_DIR, shards.SHARD_DIR_NAME)}')
+
+    shards.merge_file(settings.OUT_DIR, '_window_sizes.csv', overwrite=True)
+    shards.merge_file(settings.EXCLUSION_DIR, '_exclusions_general.csv', order=shards.sort_exclusions)
+
+    exclusion_path = os.path.join(settings.EXCLUSION_DIR, '_exclusions_general.csv')
+    if not os.path.isfile(exclusion_path):
+        exit(f'No general exclusion file found at {exclusion_path}, run step 1 on all shards first')
+
+    general_exclusions = pd.read_csv(exclusion_path)
+    utils.validate_exclusions(general_exclusions, exclusion_path)
+    participants = set(general_exclusions['id'].unique())
+
+    for handler, should_render in create_handlers(participants, general_exclusions):
+        handler.merge_shards(should_render)
+
+
+def job_stage(kind, handler):
+    """The stage telemetry.trial measures a job under, e.g. owlet_calibration for the calibration jobs of OWLET"""
+    if handler == job_queue.NO_HANDLER:
+        return kind
+    if kind.endswith('_calibration'):
+        return f'{handler}_calibration'
+    return handler
+
 
+def enqueue(participants, general_exclusions):
+    """Puts the trial-level jobs of all participants into the job queue, see src/job_queue.py"""
+    jobs = []
+    if settings.RENDER_WEBCAM_VIDEOS:
+        jobs += [('transcode', job_queue.NO_HANDLER, p, s) for p in sorted(participants) for s in settings.stimuli
+                 if os.path.isfile(f'{settings.DATA_DIR}/{p}_{s}.webm') and
+                 not os.path.isfile(f'{settings.WEBCAM_MP4_DIR}/{p}_{s}.mp4')]
 
+    for handler, _ in create_handlers(participants, general_exclusions):
+        jobs += [(kind, handler.name, p, s) for kind, p, s in handler.queue_jobs()]
+
+    # longest jobs first, by the estimated time of the job and everything that waits for it
+    model = cost_model.get()
+    costs = [model.estimate(job_stage(kind, handler), p, s) for kind, handler, p, s in jobs]
+    model.save()
+
+    queue = job_queue.JobQueue()
+    added = queue.enqueue(jobs, job_queue.critical_path_priorities(jobs, costs))
+    print(f'Added {added} new jobs to {queue.path}, jobs per status: {queue.counts()}')
+
+
+def work(participants, general_exclusions):
+    """Processes jobs from the job queue until it is drained"""
+    handlers = {handler.name: handler for handler, _ in create_handlers(participants, general_exclusions)}
+
+    def run_job(job):
+        if job['kind'] == 'transcode':
+            if not transcode_trial(job['participant'], job['stimulus']):
+                raise RuntimeError(f'Transcoding {job["participant"]}_{job["stimulus"]} failed')
+        else:
+            handlers[job['handler']].run_job(job['kind'], job['participant'], job['stimulus'])
+
+    counts = job_queue.work(job_queue.JobQueue(), run_job)
+    print(f'Job queue drained, jobs per status: {counts}')
 
 
 def get_participants():
@@ -96,6 +224,9 @@ def prepare_data(participants, render_webcam_videos):
     if not os.path.exists(settings.OUT_DIR):
         os.makedirs(settings.OUT_DIR)
 
+    if not os.path.exists(settings.RESULTS_DIR):
+        os.makedirs(settings.RESULTS_DIR)
+
     if not os.path.exists(settings.WEBCAM_MP4_DIR):
         os.makedirs(settings.WEBCAM_MP4_DIR)
 
@@ -103,23 +234,19 @@ def prepare_data(participants, render_webcam_videos):
     # due to how the data is structured, we have to assume that the window size did not change over
     # the course of the experiment, as calibration and validation did not provide that data.
     # However, as the experiment went into fullscreen, constant window dimensions are likely.
-    window_sizes_path = os.path.join(settings.OUT_DIR, '_window_sizes.csv')
+    window_sizes_path = os.path.join(settings.RESULTS_DIR, '_window_sizes.csv')
     if not os.path.isfile(window_sizes_path):
         ws_dict_list = []
         for p in participants:
 
-            data_file = f'{settings.DATA_DIR}/{p}_data.json'
-            if not os.path.isfile(data_file):
+            index = ParticipantDataIndex(p)
+            if not index.exists or index.window_width is None:
                 print(p)
                 continue
-            with open(data_file) as f:
-                data = json.load(f)
-
-            first_trial = [x for x in data if 'task' in x and x['task'] == 'video'][0]
 
             ws_dict_list.append({'id': p,
-                                 'window_width': first_trial["windowWidth"],
-                                 'window_height': first_trial["windowHeight"]
+                                 'window_width': index.window_width,
+                                 'window_height': index.window_height
                                  })
 
         pd.DataFrame(ws_dict_list).to_csv(window_sizes_path, encoding='utf-8', index=False)
@@ -127,53 +254,91 @@ def prepare_data(participants, render_webcam_videos):
     if render_webcam_videos:
         for p in participants:
             for s in settings.stimuli:
-                input_file = f'{settings.DATA_DIR}/{p}_{s}.webm'
-                temp_file = f'{settings.WEBCAM_MP4_DIR}/{p}_{s}_temp.mp4'
-                output_file = f'{settings.WEBCAM_MP4_DIR}/{p}_{s}.mp4'
-
-                if os.path.isfile(input_file) and not os.path.isfile(output_file):
-
-                    subprocess.Popen(['ffmpeg', '-y',
-                                      '-i', f'{settings.DATA_DIR}/{p}_{s}.webm',
-                                      '-filter:v',
-                                      f'fps={settings.TARGET_FPS}',
-                                      temp_file,
-                                      ]).wait()
-
-                    result = subprocess.run(["ffprobe", "-v", "error", "-show_entries",
-                                             "format=duration", "-of",
-                                             "default=noprint_wrappers=1:nokey=1", temp_file],
-                                            stdout=subprocess.PIPE,
-                                            stderr=subprocess.STDOUT)
-
-                    webcam_length = float(result.stdout.splitlines()[-1])
-                    mismatch = settings.STIMULI[s]['presentation_duration'] - webcam_length
-
-                    if mismatch > 0.0:
-                        subprocess.Popen(['ffmpeg', '-y',
-                                          '-i', temp_file,
-                                          '-filter_complex',
-                                          f'[0:v]tpad=start_duration={mismatch}[v];[0:a]adelay={mismatch*1000}s:all=true[a]',
-                                          "-map", "[v]", "-map", "[a]",
-                                          output_file,
-                                          ]).wait()
-                    elif mismatch < 0.0:
-                        subprocess.Popen(['ffmpeg',
-                                          '-y',
-                                          '-i',
-                                          temp_file,
-                                          '-ss',
-                                          f'00:00:{(-1.0) * mismatch:06.3f}',
-                                          output_file,
-                                          ]).wait()
-                    else:
-                        shutil.copy(temp_file, output_file)
-
-                    os.remove(temp_file)
+                transcode_trial(p, s)
 
     return participants
 
 
+def transcode_trial(p, s):
+    """
+    Converts the webcam video of a trial to mp4 at TARGET_FPS and pads or trims it to the presentation duration.
+    Returns False if there is a webm video but no mp4 afterwards.
+    """
+    if not os.path.exists(settings.WEBCAM_MP4_DIR):
+        os.makedirs(settings.WEBCAM_MP4_DIR, exist_ok=True)
+
+    input_file = f'{settings.DATA_DIR}/{p}_{s}.webm'
+    temp_file = f'{settings.WEBCAM_MP4_DIR}/{p}_{s}_temp.mp4'
+    output_file = f'{settings.WEBCAM_MP4_DIR}/{p}_{s}.mp4'
+
+    if os.path.isfile(input_file) and not os.path.isfile(output_file):
+        try:
+            _transcode(p, s, input_file, temp_file, output_file)
+        except RuntimeError as e:
+            # already counted as a failed trial, a partially written mp4 must not be taken for a finished one
+            print(e)
+            if os.path.isfile(output_file):
+                os.remove(output_file)
+        if os.path.isfile(temp_file):
+            os.remove(temp_file)
+
+    return not os.path.isfile(input_file) or os.path.isfile(output_file)
+
+
+def _transcode(p, s, input_file, temp_file, output_file):
+    """Raises a RuntimeError within the telemetry trial if ffmpeg fails, so that it counts as a failure of the stage"""
+    with telemetry.trial('transcode', p, s) as counter:
+        profile = settings.WEBCAM_MP4_PROFILE
+        returncode = subprocess.Popen(['ffmpeg', '-y',
+                                       '-i', input_file,
+                                       '-filter:v',
+                                       f'fps={settings.TARGET_FPS}',
+                                       ] + encoding.output_args(profile) + [
+                                       temp_file,
+                                       ]).wait()
+        if returncode != 0 or not os.path.isfile(temp_file):
+            raise RuntimeError(f'ffmpeg could not convert {input_file} (exit code {returncode})')
+
+        result = subprocess.run(["ffprobe", "-v", "error", "-show_entries",
+                                 "format=duration", "-of",
+                                 "default=noprint_wrappers=1:nokey=1", temp_file],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+
+        webcam_length = float(result.stdout.splitlines()[-1])
+        counter.add_media_seconds(webcam_length)
+        counter.add_frames(round(webcam_length * settings.TARGET_FPS))
+        mismatch = settings.STIMULI[s]['presentation_duration'] - webcam_length
+
+        if mismatch > 0.0:
+            # some recordings have no audio track, and the analysis profile drops it anyway
+            audio = encoding.keeps_audio(profile) and encoding.has_audio(temp_file)
+            returncode = subprocess.Popen(['ffmpeg', '-y',
+                                           '-i', temp_file,
+                                           '-filter_complex',
+                                           f'[0:v]tpad=start_duration={mismatch}[v]' +
+                                           (f';[0:a]adelay={mismatch*1000}s:all=true[a]' if audio else ''),
+                                           "-map", "[v]"] + (["-map", "[a]"] if audio else []) +
+                                          encoding.output_args(profile) + [
+                                           output_file,
+                                           ]).wait()
+        elif mismatch < 0.0:
+            returncode = subprocess.Popen(['ffmpeg',
+                                           '-y',
+                                           '-i',
+                                           temp_file,
+                                           '-ss',
+                                           f'00:00:{(-1.0) * mismatch:06.3f}',
+                                           ] + encoding.output_args(profile) + [
+                                           output_file,
+                                           ]).wait()
+        else:
+            shutil.copy(temp_file, output_file)
+
+        if returncode != 0 or not os.path.isfile(output_file):
+            raise RuntimeError(f'ffmpeg could not pad or trim {temp_file} (exit code {returncode})')
+
+
 if __name__ == '__main__':
     main()
 
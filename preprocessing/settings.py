@@ -24,16 +24,111 @@ EXCLUSION_DIR = os.path.join(BASE_PATH, 'exclusion')
 WEBCAM_MP4_DIR = os.path.join(OUT_DIR, 'webcam_mp4')
 CROPPED_WEBCAM_MP4_DIR = os.path.join(OUT_DIR, 'webcam_16_9_mp4')
 RENDERS_DIR = os.path.join(OUT_DIR, 'renders')
+CACHE_DIR = os.path.join(OUT_DIR, 'cache')
+PARTITION_DIR = os.path.join(OUT_DIR, 'partitions')
+# outputs covering multiple participants (data tables, window sizes, exclusion files) go here,
+# main.py --shard redirects them to a subdirectory per shard (see src/shards.py)
+RESULTS_DIR = OUT_DIR
+RESULTS_EXCLUSION_DIR = EXCLUSION_DIR
+SHARD = None
+
+# ffmpeg output options of the encoding profiles every ffmpeg call selects from (see src/encoding.py): 'analysis' for
+# intermediates only the trackers read (no audio, fast preset, a keyframe every second for cheap seeking) and 'review'
+# for videos that people watch (audio kept, higher quality). Compare them with benchmarks/encoding_profiles.py
+ENCODING_PROFILES = {
+    'analysis': {
+        'video': ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-g', str(TARGET_FPS), '-pix_fmt', 'yuv420p'],
+        'audio': None,
+    },
+    'review': {
+        'video': ['-c:v', 'libx264', '-preset', 'medium', '-crf', '20', '-pix_fmt', 'yuv420p'],
+        'audio': ['-c:a', 'aac', '-b:a', '128k'],
+    },
+    # intermediate steps of the preview renders
+    'preview': {
+        'video': ['-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '23', '-pix_fmt', 'yuv420p'],
+        'audio': None,
+    },
+}
+# profile of the webcam videos in WEBCAM_MP4_DIR, use 'review' to hear the webcam audio in the renders
+WEBCAM_MP4_PROFILE = 'analysis'
 
 RENDER_WEBGAZER = True
 RENDER_ICATCHER = True
 RENDER_OWLET_NOCALIB = True
 RENDER_OWLET = True
 RENDER_WEBCAM_VIDEOS = True
+# step 2 renders previews of all included trials (downscaled by PREVIEW_SCALE, at about PREVIEW_FPS) for a quick review,
+# full-quality renders are only made for trials marked with an x in the optional inspect column of the exclusion file
+RENDER_PREVIEWS = True
+PREVIEW_SCALE = 0.5
+PREVIEW_FPS = 10
+# render the joint videos of step 3 as previews as well
+PREVIEW_JOINT_RENDERS = False
 RENDER_WEBCAM_VIDEOS_16_9 = False
 
+# let OWLET crop the decoded webcam frames to 16:9 instead of reading the re-encoded videos in CROPPED_WEBCAM_MP4_DIR
+OWLET_CROP_ON_THE_FLY = True
+# 'cv2' decodes full frames and resizes them in Python, 'ffmpeg' lets ffmpeg deliver grayscale frames at analysis size
+# (faster, but the scaling is not bit-identical to cv2, so results can differ slightly from the original OWLET)
+OWLET_DECODER = 'cv2'
+# save the progress of OWLET every n frames, so that interrupted runs can resume (None disables checkpoints)
+OWLET_CHECKPOINT_INTERVAL = 1000
+# face detector used by OWLET: 'dlib_hog' (original OWLET), 'opencv_dnn' or 'haar', compare them with benchmarks/face_detectors.py
+OWLET_FACE_DETECTOR = 'dlib_hog'
+# analyse the OWLET calibration videos at this rate (skipped frames are not decoded into images with cv2, and are
+# dropped by ffmpeg before scaling with the ffmpeg decoder), None analyses every frame like the original OWLET
+OWLET_CALIBRATION_FPS = None
+
+# reuse the preprocessed rows of participants whose raw data did not change since the last run
+USE_PREPROCESSING_CACHE = True
+
+# keep the data of the trackers on disk (one partition per trial in PARTITION_DIR) instead of in memory, so that peak
+# memory is bounded by the largest trial rather than the whole dataset (joint renders still hold one stimulus)
+OUT_OF_CORE = False
+# rows per chunk when main.py --merge reads the merged resampled data to build the gaze cube and joint renders
+MERGE_CHUNK_ROWS = 100000
+
+# additionally export the resampled data as dense (participant x stimulus x time bin) arrays, see src/gaze_cube.py
+SAVE_GAZE_CUBE = True
+
+# proportion of target looking per time bin with bootstrapped confidence intervals, grouped by stimulus and trial
+COMPUTE_TIME_COURSES = True
+TIME_COURSE_BOOTSTRAP_SAMPLES = 2000
+TIME_COURSE_CI = 0.95
+TIME_COURSE_SEED = 1
+TIME_COURSE_WORKERS = None  # None uses all cores
+
+# job queue of main.py --enqueue and main.py --worker (see src/job_queue.py), needs to be on a filesystem that all
+# worker hosts share
+JOB_QUEUE_PATH = os.path.join(OUT_DIR, 'jobs.sqlite')
+# seconds between the heartbeats of a worker, jobs without a heartbeat for JOB_TIMEOUT seconds are claimed again
+JOB_HEARTBEAT_INTERVAL = 30
+JOB_TIMEOUT = 300
+# jobs that failed this often are not retried anymore (until the next main.py --enqueue)
+JOB_MAX_ATTEMPTS = 3
+# seconds an idle worker waits before it looks for jobs again whose dependencies are still running
+JOB_POLL_INTERVAL = 10
+
+# seconds per frame measured per stage and the video durations, used to run the longest jobs first (see src/cost_model.py)
+COST_MODEL_PATH = os.path.join(OUT_DIR, 'cost_model.json')
+# weight of the latest trial in the smoothed seconds per frame
+COST_MODEL_SMOOTHING = 0.2
+
+# throughput telemetry (see src/telemetry.py): seconds between the summary log lines (None disables them) and the
+# directory of the Prometheus textfiles for a node exporter (None disables them)
+TELEMETRY_INTERVAL = 60
+TELEMETRY_DIR = os.path.join(OUT_DIR, 'telemetry')
+
 WEBGAZER_SAMPLING_CUTOFF = 10
 
+# number of threads used to read the ICatcher result files
+ICATCHER_READ_WORKERS = 8
+# number of processes preprocessing WebGazer participants concurrently (None: one per CPU, 1: no separate processes)
+WEBGAZER_WORKERS = None
+# the final icatcher_data.csv gets written by the export anyway, only enable this to inspect the unfiltered data
+ICATCHER_WRITE_INTERIM_CSV = False
+
 GAZECODER_NAMES = {
     'OWLET': 'owlet',
     'OWLET_NOCALIB': 'owlet_nocalib',
@@ -49,24 +144,34 @@ STIMULUS_BLACKLIST = {
 }
 
 
-STIMULI = {}
-with open(os.path.join(os.path.dirname(__file__), "stimuli_metadata.csv"), 'r') as f:
-    for row in csv.DictReader(f):
-        STIMULI[row['name']] = dict(row)
+def _load_stimuli():
+    stimuli = {}
+    with open(os.path.join(os.path.dirname(__file__), "stimuli_metadata.csv"), 'r') as f:
+        for row in csv.DictReader(f):
+            stimuli[row['name']] = dict(row)
 
-for key_o, stimulus in STIMULI.items():
-    for key_i, value_i in stimulus.items():
-        try:
-            STIMULI[key_o][key_i] = int(value_i)
-        except ValueError:
+    for key_o, stimulus in stimuli.items():
+        for key_i, value_i in stimulus.items():
             try:
-                STIMULI[key_o][key_i] = float(value_i)
+                stimuli[key_o][key_i] = int(value_i)
             except ValueError:
-                STIMULI[key_o][key_i] = value_i
-
-stimuli = list(STIMULI.keys())
-stimuli_critical = list({k: v for k, v in STIMULI.items() if v['critical'] == 1}.keys())
-
-
-
-
+                try:
+                    stimuli[key_o][key_i] = float(value_i)
+                except ValueError:
+                    stimuli[key_o][key_i] = value_i
+
+    return stimuli
+
+
+def __getattr__(name):
+    # the stimulus metadata only gets parsed once it is accessed for the first time (STIMULI, stimuli, stimuli_critical)
+    if name not in ['STIMULI', 'stimuli', 'stimuli_critical']:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    stimuli = _load_stimuli()
+    globals().update({
+        'STIMULI': stimuli,
+        'stimuli': list(stimuli.keys()),
+        'stimuli_critical': list({k: v for k, v in stimuli.items() if v['critical'] == 1}.keys()),
+    })
+    return globals()[name]
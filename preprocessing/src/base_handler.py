@@ -2,10 +2,53 @@ import os
 import cv2
 import subprocess
 import shutil
+import functools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 
 import settings
 from . import utils
+from . import shards
+from . import encoding
+from .cache import ParticipantCache
+from .gaze_cube import GazeCube
+from .partitions import PartitionStore
+from .time_courses import compute_time_courses, save_time_courses
+
+# the handler a worker process of _participant_process_pool calls into
+_worker_handler = None
+
+
+def _install_worker_handler(handler):
+    global _worker_handler
+    _worker_handler = handler
+
+
+def _call_worker_handler(method_name, participant):
+    return getattr(_worker_handler, method_name)(participant)
+
+
+def _bounded_map(executor, function, items, window, submission_order=None):
+    """
+    Like executor.map, but with at most window results pending at a time, so that results that are not consumed yet
+    do not pile up in memory (e.g. in out-of-core mode). The results are yielded in the order of items, free slots are
+    filled in submission_order (by default the same), but the next result is always submitted.
+    """
+    queued = deque(submission_order if submission_order is not None else items)
+    submitted = set()
+    futures = dict()
+    for item in items:
+        if item not in submitted:
+            submitted.add(item)
+            futures[item] = executor.submit(function, item)
+        while queued and len(futures) < window:
+            next_item = queued.popleft()
+            if next_item not in submitted:
+                submitted.add(next_item)
+                futures[next_item] = executor.submit(function, next_item)
+        yield futures.pop(item).result()
 
 
 class GazecodingHandler:
@@ -13,14 +56,24 @@ class GazecodingHandler:
     def __init__(self, name, participants, general_exclusions=None):
         self.data = None
         self.data_resampled = None
+        # out-of-core mode: the data lives on disk instead of in self.data and self.data_resampled
+        self.partitions = None
+        self.partitions_resampled = None
+        # main.py --merge: the merged resampled csv, read in chunks instead of into self.data_resampled
+        self.resampled_csv = None
+        self.cube = None
+        self.time_courses = None
         self.backfill_cols = []
 
         self.name = name
         self.participants = participants
         self.general_exclusions = general_exclusions
-        self.specific_exclusions_path = os.path.join(settings.EXCLUSION_DIR,
+        # where this run writes the specific exclusions to, see shards.exclusion_file for where they are read from
+        self.specific_exclusions_path = os.path.join(settings.RESULTS_EXCLUSION_DIR,
                                                                       f'exclusions_{self.name}.csv')
         self.render_dir = os.path.join(settings.RENDERS_DIR, self.name)
+        # factor from stimulus to video coordinates of the frames being rendered, PREVIEW_SCALE for previews
+        self.render_scale = 1.0
 
         self.stimulus_blacklist = settings.STIMULUS_BLACKLIST[self.name] if self.name in settings.STIMULUS_BLACKLIST else []
 
@@ -34,13 +87,14 @@ class GazecodingHandler:
         self._preprocess()
 
         if not step or step == 2:
-            if os.path.isfile(self.specific_exclusions_path):
+            existing_exclusions_path = shards.exclusion_file(f'exclusions_{self.name}.csv')
+            if os.path.isfile(existing_exclusions_path):
                 # already there, do nothing if you are doing a full run, abort if you are on step 2
                 if step == 2:
-                    exit(f'Specific exclusion file  at {self.specific_exclusions_path} already exists. '
+                    exit(f'Specific exclusion file  at {existing_exclusions_path} already exists. '
                          f'To make sure that you are not accidentally overwriting it, please remove it first.')
-                specific_exclusions = pd.read_csv(self.specific_exclusions_path)
-                utils.validate_exclusions(specific_exclusions, self.specific_exclusions_path, strict=step)
+                specific_exclusions = pd.read_csv(existing_exclusions_path)
+                utils.validate_exclusions(specific_exclusions, existing_exclusions_path, strict=step)
             else:
                 specific_exclusions = self.general_exclusions[(self.general_exclusions['excluded'] != 'x') & (~self.general_exclusions['stimulus'].isin(self.stimulus_blacklist))].reset_index(drop=True)
                 specific_exclusions['excluded'] = ''
@@ -50,60 +104,280 @@ class GazecodingHandler:
                 specific_exclusions.to_csv(self.specific_exclusions_path, encoding='utf-8', index=False)
 
             if should_render:
-                # Only render trials that were not excluded generally or automatically
+                # Only render trials that were not excluded generally or automatically: previews of all of them for
+                # a quick review, full-quality renders of the ones marked for closer inspection
                 included_so_far = specific_exclusions[specific_exclusions['excluded'] != 'x']
-                for _, row in included_so_far.iterrows():
+                flagged = self._flagged_for_inspection(included_so_far)
+                for (_, row), inspect in zip(included_so_far.iterrows(), flagged):
                     if row['stimulus'] in self.stimulus_blacklist:
                         continue
-                    #self._render(row['id'], row['stimulus'])
+                    if settings.RENDER_PREVIEWS:
+                        self._render(row['id'], row['stimulus'], preview=True)
+                    if inspect:
+                        self._render(row['id'], row['stimulus'])
 
         if not step or step == 3:
 
             self._filter_data(step)
             self._resample_data()
+            self._aggregate_data()
 
-            if should_render:
+            # joint renders need the data of all participants, sharded runs leave them to the merge
+            if should_render and settings.SHARD is None:
                 for s in settings.stimuli:
                     if s in self.stimulus_blacklist:
                         continue
-                    self._render_joint(s)
+                    self._render_joint(s, preview=settings.PREVIEW_JOINT_RENDERS)
 
             self._save_data()
 
+    def render_inspections(self):
+        """
+        Full-quality renders of the trials marked with an x in the inspect column of the specific exclusion file,
+        after reviewing the previews of step 2 (main.py --inspect). Only the participants with flagged trials get
+        preprocessed again.
+        """
+        existing_exclusions_path = shards.exclusion_file(f'exclusions_{self.name}.csv')
+        if not os.path.isfile(existing_exclusions_path):
+            exit(f'No specific exclusion file found at {existing_exclusions_path}, run step 2 first')
+
+        specific_exclusions = pd.read_csv(existing_exclusions_path)
+        flagged = specific_exclusions[self._flagged_for_inspection(specific_exclusions) &
+                                      ~specific_exclusions['stimulus'].isin(self.stimulus_blacklist)]
+        if len(flagged.index) == 0:
+            return
+
+        if self.general_exclusions is None:
+            self.general_exclusions = utils.create_empty_general_exclusion_df(self.participants)
+
+        all_participants = self.participants
+        flagged_participants = set(flagged['id'].astype(str))
+        self.participants = {p for p in all_participants if p in flagged_participants}
+        try:
+            self._preprocess()
+            for _, row in flagged.iterrows():
+                self._render(row['id'], row['stimulus'])
+        finally:
+            self.participants = all_participants
+
+    @staticmethod
+    def _flagged_for_inspection(exclusions):
+        """Trials marked with an x in the optional inspect column of a specific exclusion file"""
+        if 'inspect' not in exclusions.columns:
+            return pd.Series(False, index=exclusions.index)
+        return exclusions['inspect'] == 'x'
+
     def _should_process_trial(self, participant, stimulus):
         return self.general_exclusions[(self.general_exclusions['id'] == participant) & (self.general_exclusions['stimulus'] == stimulus)]['excluded'].iloc[0] != 'x' and stimulus not in self.stimulus_blacklist
 
     def _preprocess(self):
         pass
 
+    def _trials_to_process(self):
+        """(participant, stimulus) of all trials that are neither excluded generally nor blacklisted for this tracker"""
+        if self.general_exclusions is None:
+            self.general_exclusions = utils.create_empty_general_exclusion_df(self.participants)
+        return [(p, s) for p in sorted(self.participants) for s in settings.stimuli if self._should_process_trial(p, s)]
+
+    @staticmethod
+    def _has_webcam_video(p, s):
+        """Whether a trial has a webcam video, either transcoded already or as a recording a transcode job converts"""
+        return os.path.isfile(f'{settings.WEBCAM_MP4_DIR}/{p}_{s}.mp4') or \
+            os.path.isfile(f'{settings.DATA_DIR}/{p}_{s}.webm')
+
+    def queue_jobs(self):
+        """
+        (kind, participant, stimulus) of the jobs main.py --enqueue puts into the job queue (see src/job_queue.py).
+        _preprocess picks up the results of finished jobs instead of computing them again.
+        """
+        return []
+
+    def run_job(self, kind, participant, stimulus):
+        """Runs a job claimed from the job queue by main.py --worker"""
+        raise ValueError(f'{self.name} has no jobs of kind {kind}')
+
+    def _cache_params(self, participant):
+        return [s for s in settings.stimuli if self._should_process_trial(participant, s)]
+
+    def _collect_participant_data(self, source_files, preprocess_participant, executor=None, workers=None):
+        """
+        Calls preprocess_participant(participant) for all participants whose source files (as returned by
+        source_files(participant)) changed since the last run and takes the cached results for everyone else.
+        If an executor with the given number of workers is passed, the participants that need preprocessing are mapped
+        over it concurrently (the ones with the largest source files first, at most twice as many as there are workers
+        at a time).
+        Participants without any source files are skipped. Returns the results in participant order.
+        """
+        return list(self._iter_participant_data(source_files, preprocess_participant, executor, workers))
+
+    def _iter_participant_data(self, source_files, preprocess_participant, executor=None, workers=None):
+        """Like _collect_participant_data, but yields the results one by one instead of holding all of them"""
+        cache = ParticipantCache(self.name) if settings.USE_PREPROCESSING_CACHE else None
+
+        sources = dict()
+        params = dict()
+        cached = set()
+        missing = []
+        for p in sorted(self.participants):
+            sources[p] = source_files(p)
+            if len(sources[p]) == 0:
+                continue
+
+            params[p] = self._cache_params(p)
+            if cache and cache.is_valid(p, sources[p], params[p]):
+                cached.add(p)
+            else:
+                missing.append(p)
+
+        if executor:
+            # the largest participants are submitted first, so that none of them is left running at the end on its own
+            size = lambda p: sum(os.path.getsize(f) for f in sources[p] if os.path.isfile(f))
+            preprocessed = _bounded_map(executor, preprocess_participant, missing, 2 * (workers or os.cpu_count()),
+                                        sorted(missing, key=size, reverse=True))
+        else:
+            preprocessed = map(preprocess_participant, missing)
+
+        for p in sorted(sources.keys()):
+            if len(sources[p]) == 0:
+                continue
+
+            if p in cached:
+                yield cache.read(p)
+                continue
+
+            # missing is in participant order as well
+            result = next(preprocessed)
+            if cache:
+                cache.store(p, sources[p], result, params[p])
+            yield result
+
+    def _store_data(self, frames):
+        """
+        Takes the preprocessed data of all participants (an iterable of frames in participant order) and either
+        concatenates it to self.data or, in out-of-core mode, writes it trial by trial to self.partitions
+        """
+        if not settings.OUT_OF_CORE:
+            self.data = pd.concat(frames)\
+                .sort_values(['id', 'trial', 't']) \
+                .reset_index(drop=True)
+            return
+
+        self.partitions = PartitionStore(self.name, 'data')
+        self.partitions.clear()
+        for data in frames:
+            if len(data.index) > 0:
+                self.partitions.write(data.sort_values(['trial', 't']))
+
+    def _trial_data(self, participant, stimulus):
+        if self.partitions is not None:
+            if (participant, stimulus) not in self.partitions.partitions:
+                return pd.DataFrame()
+            return self.partitions.get(participant, stimulus)
+        return self.data[(self.data['id'] == participant) & (self.data['stimulus'] == stimulus)]
+
+    def _stimulus_data_resampled(self, stimulus):
+        if self.resampled_csv is not None:
+            frames = [chunk[chunk['stimulus'] == stimulus] for chunk in
+                      pd.read_csv(self.resampled_csv, dtype={'id': str}, chunksize=settings.MERGE_CHUNK_ROWS)]
+            return pd.concat(frames) if len(frames) > 0 else pd.DataFrame()
+        if self.partitions_resampled is not None:
+            frames = [self.partitions_resampled.get(p, s) for p, s in self.partitions_resampled.keys(by_trial=True)
+                      if s == stimulus]
+            return pd.concat(frames) if len(frames) > 0 else pd.DataFrame()
+        return self.data_resampled[self.data_resampled['stimulus'] == stimulus]
+
+    def _participant_process_pool(self, workers):
+        """
+        Process pool for _collect_participant_data. Every worker receives a copy of the handler once when it starts,
+        so that only participant ids and results have to be sent back and forth. Map _in_worker(method_name) over it.
+        """
+        return ProcessPoolExecutor(max_workers=workers, initializer=_install_worker_handler, initargs=(self,))
+
+    @staticmethod
+    def _in_worker(method_name):
+        return functools.partial(_call_worker_handler, method_name)
+
     def _get_exclusion_functions(self):
+        """
+        Returns a list of (function, reason) tuples. Each function receives the per-trial summary table created by
+        _summarize_trials (one row per id x stimulus) and returns a boolean mask of the trials to exclude.
+        If multiple functions exclude a trial, the first reason in the list is used.
+        """
         return []
 
-    def _automatically_exclude_specific(self, general_exclusions):
+    def _get_trial_aggregations(self):
+        """Named aggregations (as passed to DataFrame.agg) of the tracker data that the exclusion functions need"""
+        return {}
+
+    def _summarize_trials(self, trials):
+        aggregations = {'n_samples': ('t', 'size'), **self._get_trial_aggregations()}
+        if self.partitions is not None:
+            summaries = [data.groupby(['id', 'stimulus'], as_index=False).agg(**aggregations)
+                         for data in self.partitions.frames()]
+            summary = pd.concat(summaries) if len(summaries) > 0 \
+                else pd.DataFrame(columns=['id', 'stimulus'] + list(aggregations.keys()))
+        else:
+            summary = self.data.groupby(['id', 'stimulus'], as_index=False).agg(**aggregations)
+
+        summary = trials[['id', 'stimulus']].merge(summary, on=['id', 'stimulus'], how='left')
+        summary['n_samples'] = summary['n_samples'].fillna(0)
+        return summary
 
+    def _get_exclusion_rules(self):
         # tag all participants that are missing in the eyetracking data of the given tracker (dont appear in the data)
-        in_data = self.data[['id', 'stimulus']].drop_duplicates(keep='first').reset_index(drop=True)
-        in_exclusion = general_exclusions[['id', 'stimulus']].drop_duplicates(keep='first').reset_index(drop=True)
-        nodata_table = pd.merge(in_exclusion, in_data, indicator=True, how='outer').query('_merge=="left_only"').drop('_merge', axis=1)
-        nodata_table['excluded'] = 'x'
-        nodata_table['exclusion_reason'] = '_no_tracker_data'
+        return [(lambda trials: trials['n_samples'] == 0, '_no_tracker_data')] + self._get_exclusion_functions()
+
+    def _automatically_exclude_specific(self, specific_exclusions):
+
+        # all rules get evaluated on a table with one row per trial that is built once
+        summary = self._summarize_trials(specific_exclusions)
 
-        exclusion_tables = [nodata_table]
+        rules = self._get_exclusion_rules()
 
-        for fun, reason in self._get_exclusion_functions():
-            excl_table = fun(self.data)
-            excl_table['excluded'] = 'x'
-            excl_table['exclusion_reason'] = reason
-            exclusion_tables.append(excl_table)
+        reasons = pd.Series('', index=summary.index)
+        rank = pd.Series(len(rules), index=summary.index)
+        for i, (rule, reason) in enumerate(rules):
+            hit = rule(summary).to_numpy(dtype=bool) & (reasons == '')
+            reasons[hit] = reason
+            rank[hit] = i
 
-        return pd.concat(exclusion_tables + [general_exclusions]).drop_duplicates(subset=['id', 'stimulus'],
-                                                                      keep="first").reset_index(drop=True)
+        excluded = reasons != ''
+        specific_exclusions = specific_exclusions.copy()
+        specific_exclusions.loc[excluded, 'excluded'] = 'x'
+        specific_exclusions.loc[excluded, 'exclusion_reason'] = reasons[excluded]
+
+        # keep the layout of the exclusion files: automatic exclusions first, grouped by reason
+        return specific_exclusions.assign(_rank=rank)\
+            .sort_values('_rank', kind='stable')\
+            .drop('_rank', axis=1)\
+            .reset_index(drop=True)
 
     def _filter_data(self, step):
-        specific_exclusions = pd.read_csv(self.specific_exclusions_path)
-        utils.validate_exclusions(specific_exclusions, self.specific_exclusions_path, strict=step and step == 3)
+        specific_exclusions_path = shards.exclusion_file(f'exclusions_{self.name}.csv')
+        specific_exclusions = pd.read_csv(specific_exclusions_path)
+        utils.validate_exclusions(specific_exclusions, specific_exclusions_path, strict=step and step == 3)
         exclusions_all = pd.concat([specific_exclusions, self.general_exclusions])
         excluded = exclusions_all[(exclusions_all['excluded'] == 'x') & (~exclusions_all['stimulus'].isin(self.stimulus_blacklist))].reset_index(drop=True)
+        # optional columns like inspect must not end up in the data
+        excluded = excluded[['id', 'stimulus', 'excluded', 'exclusion_reason']]
+
+        if self.partitions is not None:
+            excluded_trials = set(zip(excluded['id'], excluded['stimulus']))
+            trials = self.partitions.keys()
+            for key in trials:
+                if key in excluded_trials:
+                    self.partitions.remove(*key)
+
+            # the outer merge below adds (and drops again) rows for excluded trials without data, which turns integer
+            # columns into floats - do the same here, so that both modes write identical files
+            if len(excluded_trials - set(trials)) > 0:
+                for key in self.partitions.keys():
+                    data = self.partitions.get(*key)
+                    upcast = {c: 'float64' for c in data.columns if pd.api.types.is_integer_dtype(data[c])}
+                    if len(upcast) > 0:
+                        self.partitions.put(*key, data.astype(upcast))
+            return
+
         self.data = pd.merge(self.data, excluded, on=['id', 'stimulus'], how='outer')
         self.data = self.data[self.data['excluded'] != 'x']\
             .drop(['excluded', 'exclusion_reason'], axis=1)\
@@ -113,19 +387,32 @@ class GazecodingHandler:
         if backfill_cols is None:
             backfill_cols = ['trial']
 
+        if self.partitions is None:
+            self.data_resampled = self._resample(self.data, backfill_cols)
+            return
+
+        # resampling never looks beyond the rows of a single trial, so it can run partition by partition
+        self.partitions_resampled = PartitionStore(self.name, 'resampled')
+        self.partitions_resampled.clear()
+        for participant, stimulus in self.partitions.keys():
+            self.partitions_resampled.put(participant, stimulus,
+                                          self._resample(self.partitions.get(participant, stimulus), backfill_cols))
+
+    @staticmethod
+    def _resample(data, backfill_cols):
         # use the max trial duration for all stimuli to simplify temp_df creation -> delete the nonsensical rows in the next step
         max_duration_seconds = max([stim['presentation_duration'] for key, stim in settings.STIMULI.items()])
         tmp_df = pd.DataFrame({'t': range(0, int(max_duration_seconds * 1000 + 1), int(1000 / settings.RESAMPLING_RATE)), 'new': True})\
-            .merge(self.data[['id', 'stimulus']].drop_duplicates(keep='first').reset_index(drop=True), how='cross')
+            .merge(data[['id', 'stimulus']].drop_duplicates(keep='first').reset_index(drop=True), how='cross')
 
         tmp_df['max_timestamp'] = [settings.STIMULI[stim]['presentation_duration'] * 1000 for stim in tmp_df['stimulus']]
         tmp_df = tmp_df[tmp_df['t'] <= tmp_df['max_timestamp']]\
             .drop('max_timestamp', axis=1)\
             .reset_index(drop=True)
 
-        self.data_resampled = self.data.copy()
-        self.data_resampled['new'] = False
-        self.data_resampled = pd.concat([self.data_resampled, tmp_df])\
+        data_resampled = data.copy()
+        data_resampled['new'] = False
+        data_resampled = pd.concat([data_resampled, tmp_df])\
             .sort_values(['t', 'new'], ascending=[True, True])\
             .groupby(['id', 'stimulus'], as_index=False)\
             .apply(lambda x: x.fillna(method="ffill"))\
@@ -134,30 +421,104 @@ class GazecodingHandler:
             .sort_values(['id', 'stimulus', 't'])\
             .reset_index(drop=True)
 
-        self.data_resampled.loc[:, backfill_cols] = self.data_resampled.loc[:, backfill_cols].bfill()
-        self.data_resampled = self.data_resampled.sort_values(['id', 'trial', 't']).reset_index(drop=True)
+        data_resampled.loc[:, backfill_cols] = data_resampled.loc[:, backfill_cols].bfill()
+        return data_resampled.sort_values(['id', 'trial', 't']).reset_index(drop=True)
+
+    def _aggregate_data(self):
+        if not settings.SAVE_GAZE_CUBE and not settings.COMPUTE_TIME_COURSES:
+            return
+
+        # in out-of-core mode, the cube is memory-mapped directly in the place it gets saved to
+        path = None
+        if settings.OUT_OF_CORE:
+            path = f'{settings.RESULTS_DIR}/{self.name}_cube' if settings.SAVE_GAZE_CUBE else \
+                os.path.join(settings.PARTITION_DIR, self.name, 'cube')
+
+        if self.resampled_csv is not None:
+            self.cube = GazeCube.from_csv(self.resampled_csv, path=path)
+        elif self.partitions_resampled is not None:
+            self.cube = GazeCube.from_partitions(self.partitions_resampled, path=path)
+        else:
+            self.cube = GazeCube.from_resampled(self.data_resampled)
+
+        if settings.COMPUTE_TIME_COURSES:
+            workers = settings.TIME_COURSE_WORKERS or os.cpu_count()
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                self.time_courses = compute_time_courses(self.cube, executor, window=2 * workers)
 
     def _save_data(self):
-        self.data.to_csv(f'{settings.OUT_DIR}/{self.name}_data.csv', encoding='utf-8', index=False)
-        self.data_resampled.to_csv(f'{settings.OUT_DIR}/{self.name}_RESAMPLED_data.csv', encoding='utf-8', index=False)
+        if self.partitions is not None:
+            # same row order as the in-memory outputs: data by id and stimulus, resampled data by id and trial
+            self.partitions.to_csv(f'{settings.RESULTS_DIR}/{self.name}_data.csv')
+            self.partitions_resampled.to_csv(f'{settings.RESULTS_DIR}/{self.name}_RESAMPLED_data.csv', by_trial=True)
+        else:
+            self.data.to_csv(f'{settings.RESULTS_DIR}/{self.name}_data.csv', encoding='utf-8', index=False)
+            self.data_resampled.to_csv(f'{settings.RESULTS_DIR}/{self.name}_RESAMPLED_data.csv', encoding='utf-8', index=False)
+
+        self._save_aggregates()
+
+    def _save_aggregates(self):
+        if settings.SAVE_GAZE_CUBE:
+            self.cube.save(f'{settings.RESULTS_DIR}/{self.name}_cube')
+
+        if self.time_courses is not None:
+            save_time_courses(self.time_courses, self.name, settings.RESULTS_DIR)
 
-    def _render_pre_loop(self, input_path, output_path, participant, stimulus):
+    def _result_files(self):
+        """The csv files in RESULTS_DIR that main.py --merge combines"""
+        return [f'{self.name}_data.csv', f'{self.name}_RESAMPLED_data.csv']
+
+    def merge_shards(self, should_render):
         """
-        Whatever needs to be done before the main rendering loop runs, rendering the data on the data
+        Combines the results and automatic exclusions of all shards into the layout of a single run and creates the
+        outputs that need the data of all participants (gaze cube, time courses, joint renders)
         """
-        shutil.copy(input_path, output_path)
+        for filename in self._result_files():
+            shards.merge_file(settings.OUT_DIR, filename, overwrite=True, stream=True)
+
+        reasons = [reason for _, reason in self._get_exclusion_rules()]
+        shards.merge_file(settings.EXCLUSION_DIR, f'exclusions_{self.name}.csv',
+                          order=lambda exclusions: shards.sort_exclusions(exclusions, reasons))
+
+        resampled_path = f'{settings.OUT_DIR}/{self.name}_RESAMPLED_data.csv'
+        if not os.path.isfile(resampled_path):
+            return
+
+        self.resampled_csv = resampled_path
+        self._aggregate_data()
+        self._save_aggregates()
+
+        if should_render:
+            for s in settings.stimuli:
+                if s in self.stimulus_blacklist:
+                    continue
+                self._render_joint(s, preview=settings.PREVIEW_JOINT_RENDERS)
+
+    def _render_pre_loop(self, input_path, output_path, participant, stimulus, preview=False):
+        """
+        Whatever needs to be done before the main rendering loop runs, rendering the data on the data. For previews,
+        this has to reduce the video to the preview size and frame rate.
+        """
+        if preview:
+            self._scale_to_preview(input_path, output_path)
+        else:
+            shutil.copy(input_path, output_path)
 
     def _render_frame(self, frame, index, data):
         pass
 
-    def _render_post_loop(self, input_path, output_path, participant, stimulus):
+    def _render_post_loop(self, input_path, output_path, participant, stimulus, preview=False):
         """
         Whatever needs to be done after the main rendering loop runs, rendering the data on the data
         """
         shutil.copy(input_path, output_path)
 
-    def _render(self, participant, stimulus):
-        d = self.data[(self.data['id'] == participant) & (self.data['stimulus'] == stimulus)]
+    def _render(self, participant, stimulus, preview=False):
+        """
+        Renders the data of a trial onto the stimulus. For previews, the first ffmpeg pass already reduces the video to
+        PREVIEW_SCALE and PREVIEW_FPS, so all later passes and the rendering loop only handle small frames.
+        """
+        d = self._trial_data(participant, stimulus)
         d.reset_index(drop=True, inplace=True)
 
         if len(d.index) == 0:
@@ -171,7 +532,7 @@ class GazecodingHandler:
         if not os.path.exists(base_path):
             os.makedirs(base_path)
 
-        stimulus_file = f'{stimulus}.mp4'
+        stimulus_file = f'{stimulus}_preview.mp4' if preview else f'{stimulus}.mp4'
         pre1_path = f'{base_path}/pre1_{stimulus_file}'
         pre2_path = f'{base_path}/pre2_{stimulus_file}'
         final_path = f'{base_path}/{stimulus_file}'
@@ -180,7 +541,8 @@ class GazecodingHandler:
             return
         print(f'Rendering {final_path}...')
 
-        self._render_pre_loop(f'{settings.MEDIA_DIR}/{stimulus_file}', pre1_path, participant, stimulus)
+        self.render_scale = settings.PREVIEW_SCALE if preview else 1.0
+        self._render_pre_loop(f'{settings.MEDIA_DIR}/{stimulus}.mp4', pre1_path, participant, stimulus, preview)
 
         video, video_writer, fps = self._prepare_cv2_video(pre1_path, pre2_path)
         success, frame = video.read()
@@ -188,7 +550,8 @@ class GazecodingHandler:
         gaze_point_index = 1
 
         while success:
-            if gaze_point_index < len(d.index) - 1 and d['t'][gaze_point_index + 1] <= (frame_index / fps) * 1000:
+            # the frames of previews are further apart than the gaze points, so this might skip several of them
+            while gaze_point_index < len(d.index) - 1 and d['t'][gaze_point_index + 1] <= (frame_index / fps) * 1000:
                 gaze_point_index += 1
 
             self._render_frame(frame, gaze_point_index, d)
@@ -202,7 +565,7 @@ class GazecodingHandler:
         video.release()
         video_writer.release()
 
-        self._render_post_loop(pre2_path, final_path, participant, stimulus)
+        self._render_post_loop(pre2_path, final_path, participant, stimulus, preview)
 
         try:
             os.remove(pre1_path)
@@ -214,28 +577,40 @@ class GazecodingHandler:
         except OSError:
             pass
 
+    def _prepare_joint_data(self, data):
+        """
+        Gets called once per joint render with the resampled data of the stimulus. Whatever is returned gets passed
+        to _render_frame_joint, which allows handlers to index the data by timestep instead of filtering every frame.
+        """
+        return data
+
     def _render_frame_joint(self, frame, index, data):
         pass
 
-    def _render_joint(self, stimulus):
+    def _render_joint(self, stimulus, preview=False):
 
         if not os.path.exists(self.render_dir):
             os.makedirs(self.render_dir)
 
-        pre_path = f'{self.render_dir}/{stimulus}_all_temp.mp4'
-        final_path = f'{self.render_dir}/{stimulus}_all.mp4'
+        name = f'{stimulus}_all_preview' if preview else f'{stimulus}_all'
+        pre_path = f'{self.render_dir}/{name}_temp.mp4'
+        final_path = f'{self.render_dir}/{name}.mp4'
 
         if os.path.isfile(final_path):
             return
 
-        self._overlay_fc(f'{settings.MEDIA_DIR}/{stimulus}.mp4', pre_path)
+        self.render_scale = settings.PREVIEW_SCALE if preview else 1.0
+        self._overlay_fc(f'{settings.MEDIA_DIR}/{stimulus}.mp4', pre_path, 'preview' if preview else 'review',
+                         scale_to_preview=preview)
 
-        d = self.data_resampled[self.data_resampled['stimulus'] == stimulus]
+        d = self._stimulus_data_resampled(stimulus)
         d.reset_index(drop=True, inplace=True)
 
         if len(d.index) == 0:
             return
 
+        d = self._prepare_joint_data(d)
+
         video, video_writer, fps = self._prepare_cv2_video(pre_path, final_path)
 
         success, frame = video.read()
@@ -252,7 +627,8 @@ class GazecodingHandler:
             video_writer.write(frame)
             success, frame = video.read()
 
-            if t <= (frame_index / fps) * 1000:
+            # previews might have fewer frames per second than the resampled data has timesteps
+            while t <= (frame_index / fps) * 1000:
                 t += timestep
             frame_index += 1
 
@@ -280,27 +656,53 @@ class GazecodingHandler:
         return video, video_writer, fps
 
     @staticmethod
-    def _overlay_fc(input_path, output_path):
+    def _preview_filter():
+        # even dimensions, as most encoders require them
+        return f'scale=trunc(iw*{settings.PREVIEW_SCALE}/2)*2:-2,fps={settings.PREVIEW_FPS}'
+
+    @staticmethod
+    def _scale_to_preview(input_path, output_path):
+        subprocess.Popen(['ffmpeg', '-y',
+                          '-i', input_path,
+                          '-vf',
+                          GazecodingHandler._preview_filter(),
+                          ] + encoding.output_args('preview') + [
+                          output_path,
+                          ]).wait()
+
+    @staticmethod
+    def _webcam_width(preview=False):
+        return int(350 * settings.PREVIEW_SCALE) // 2 * 2 if preview else 350
+
+    @staticmethod
+    def _overlay_fc(input_path, output_path, profile='review', scale_to_preview=False):
         # add frame counter to video
+        preview_filter = f'{GazecodingHandler._preview_filter()},' if scale_to_preview else ''
         subprocess.Popen(['ffmpeg', '-y',
                           '-i', input_path,
                           '-vf',
-                          "drawtext=fontfile=Arial.ttf: text='%{frame_num} / %{pts}': start_number=1: x=(w-tw)/2: y=h-lh: fontcolor=black: fontsize=(h/20): box=1: boxcolor=white: boxborderw=5",
-                          '-c:a', 'copy', '-c:v', 'libx264', '-crf', '23',
+                          preview_filter + "drawtext=fontfile=Arial.ttf: text='%{frame_num} / %{pts}': start_number=1: x=(w-tw)/2: y=h-lh: fontcolor=black: fontsize=(h/20): box=1: boxcolor=white: boxborderw=5",
+                          ] + encoding.output_args(profile) + [
                           output_path,
                           ]).wait()
 
     @staticmethod
-    def _overlay_webcam(input_path, output_path, webcam_path, audio=False):
+    def _overlay_webcam(input_path, output_path, webcam_path, audio=False, profile='review', width=350,
+                        scale_to_preview=False):
         if os.path.isfile(webcam_path):
+            main = f'[0:v]{GazecodingHandler._preview_filter()} [main];[main]' if scale_to_preview else '[0:v]'
             subprocess.Popen(['ffmpeg', '-y',
                               '-i', input_path,
                               '-i', webcam_path,
                               '-filter_complex',
-                              "[1:v]scale=350:-1 [inner];[0:v][inner]overlay=10:10:shortest=0[out]",
+                              f"[1:v]scale={width}:-2 [inner];{main}[inner]overlay=10:10:shortest=0[out]",
                               # [1:v]scale=350:-1,hflip take out the flip for now - especially for icatcher
-                              '-map', '[out]'] + (['-map', '1:a'] if audio else []) + [output_path]
-                            ).wait()
+                              # the webcam videos only have audio if WEBCAM_MP4_PROFILE keeps it
+                              '-map', '[out]'] + (['-map', '1:a?'] if audio else []) +
+                             encoding.output_args(profile) + [output_path]
+                             ).wait()
 
+        elif scale_to_preview:
+            GazecodingHandler._scale_to_preview(input_path, output_path)
         else:
             shutil.copy(input_path, output_path)
@@ -1,6 +1,5 @@
 import os
 import cv2
-import statistics
 import numpy as np
 
 import settings
@@ -13,15 +12,19 @@ class EyetrackingHandler(GazecodingHandler):
         super().__init__(name, participants, general_exclusions)
 
         self.dot_color = dot_color
+        self.dot_stamp = self._create_dot_stamp(10)
 
-    def _render_pre_loop(self, input_path, output_path, participant, stimulus):
+    def _render_pre_loop(self, input_path, output_path, participant, stimulus, preview=False):
 
         path, _, ending = output_path.rpartition('.')
         tmp_path = f'{path}_tmp.{ending}'
 
+        # previews get scaled down in the first pass, so that the frame counter is drawn onto the small frames already
+        profile = 'preview' if preview else 'review'
         webcam_path = f'{settings.WEBCAM_MP4_DIR}/{participant}_{stimulus}.mp4'
-        self._overlay_webcam(input_path, tmp_path, webcam_path, audio=True)
-        self._overlay_fc(tmp_path, output_path)
+        self._overlay_webcam(input_path, tmp_path, webcam_path, audio=not preview, profile=profile,
+                             width=self._webcam_width(preview), scale_to_preview=preview)
+        self._overlay_fc(tmp_path, output_path, profile)
 
         try:
             os.remove(tmp_path)
@@ -30,40 +33,54 @@ class EyetrackingHandler(GazecodingHandler):
 
     def _render_frame(self, frame, index, data):
         if not data.outside[index]:
-            cv2.circle(frame, (data.x[index], data.y[index]), radius=10,
-                       color=(255, 0, 0), thickness=-1)
+            cv2.circle(frame, (int(data.x[index] * self.render_scale), int(data.y[index] * self.render_scale)),
+                       radius=max(1, round(10 * self.render_scale)), color=(255, 0, 0), thickness=-1)
+
+    def _prepare_joint_data(self, data):
+        # only points that lie on the stimulus are drawn, at the size of the frames being rendered
+        self.dot_stamp = self._create_dot_stamp(max(1, round(10 * self.render_scale)))
+        drawn = data[(data['x'].notna()) & (data['y'].notna()) & (data['outside'].eq(False))]
+        return {int(t): ((group['x'].to_numpy() * self.render_scale).astype(np.int64),
+                         (group['y'].to_numpy() * self.render_scale).astype(np.int64))
+                for t, group in drawn.groupby('t')}
 
     def _render_frame_joint(self, frame, t, data):
-        timepoint_data = data[(data['t'] == int(t)) & (data['x'].notna()) & (data['y'].notna())]
-        timepoint_data.reset_index(drop=True, inplace=True)
-
-        if len(timepoint_data.index) > 0:
-
-            x_values_drawn = []
-            y_values_drawn = []
-            for _, row in timepoint_data.iterrows():
-                if not row['outside']:
-                    cv2.circle(frame, (int(row['x']), int(row['y'])), radius=10, color=self.dot_color, thickness=-1)
-                    x_values_drawn.append(row['x'])
-                    y_values_drawn.append(row['y'])
-
-            if len(x_values_drawn) == 0:
-                return
-
-            cv2.circle(frame,
-                       (int(statistics.median(x_values_drawn)),
-                        int(statistics.median(y_values_drawn))),
-                       radius=15,
-                       color=(0, 0, 255), thickness=-1)
-
-            if len(x_values_drawn) == 1:
-                return
-
-            cv2.ellipse(frame,
-                        (int(statistics.median(x_values_drawn)), int(statistics.median(y_values_drawn))),
-                        (int(statistics.stdev(x_values_drawn)), int(statistics.stdev(y_values_drawn))), 0.,
-                        0., 360,
-                        (255, 255, 255), thickness=3)
+        if int(t) not in data:
+            return
+
+        x_values_drawn, y_values_drawn = data[int(t)]
+        self._draw_dots(frame, x_values_drawn, y_values_drawn, self.dot_stamp, self.dot_color)
+
+        median_x, median_y = int(np.median(x_values_drawn)), int(np.median(y_values_drawn))
+        cv2.circle(frame, (median_x, median_y), radius=max(1, round(15 * self.render_scale)), color=(0, 0, 255),
+                   thickness=-1)
+
+        if len(x_values_drawn) == 1:
+            return
+
+        cv2.ellipse(frame,
+                    (median_x, median_y),
+                    (int(np.std(x_values_drawn, ddof=1)), int(np.std(y_values_drawn, ddof=1))), 0.,
+                    0., 360,
+                    (255, 255, 255), thickness=max(1, round(3 * self.render_scale)))
+
+    @staticmethod
+    def _create_dot_stamp(radius):
+        """Returns the pixel offsets of a filled circle relative to its centre"""
+        offsets = np.arange(-radius, radius + 1)
+        dy, dx = np.meshgrid(offsets, offsets, indexing='ij')
+        inside = dx ** 2 + dy ** 2 <= radius ** 2
+        return dy[inside], dx[inside]
+
+    @staticmethod
+    def _draw_dots(frame, xs, ys, stamp, color):
+        """Draws a filled circle for every centre in xs/ys with a single fancy-indexing assignment"""
+        dy, dx = stamp
+        py = (ys[:, None] + dy[None, :]).ravel()
+        px = (xs[:, None] + dx[None, :]).ravel()
+
+        visible = (py >= 0) & (py < frame.shape[0]) & (px >= 0) & (px < frame.shape[1])
+        frame[py[visible], px[visible]] = color
 
     @staticmethod
     def _translate_coordinates(video_aspect_ratio, win_height, win_width, vid_height, vid_width, winX, winY):
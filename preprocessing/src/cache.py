@@ -0,0 +1,89 @@
+import os
+import json
+import pickle
+import hashlib
+
+import settings
+
+
+def file_fingerprint(path, known=None):
+    """
+    Returns mtime, size and sha1 of a file. If a previously recorded fingerprint is passed and mtime and size
+    still match, the (expensive) hash is taken from it instead of being recomputed.
+    """
+    stat = os.stat(path)
+    if known is not None and known['mtime'] == stat.st_mtime and known['size'] == stat.st_size:
+        return dict(known)
+
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+
+    return {'mtime': stat.st_mtime, 'size': stat.st_size, 'sha1': sha1.hexdigest()}
+
+
+class ParticipantCache:
+    """
+    Stores the preprocessed rows of each participant of a tracker on disk, keyed by the fingerprints of the source
+    files they were created from. A changed mtime alone does not invalidate an entry as long as the content hash
+    stays the same (e.g. after copying the data directory).
+    """
+
+    def __init__(self, name):
+        self.cache_dir = os.path.join(settings.CACHE_DIR, name)
+
+    def _paths(self, participant):
+        base = os.path.join(self.cache_dir, participant)
+        return f'{base}.json', f'{base}.pkl'
+
+    def is_valid(self, participant, source_files, params=None):
+        """Checks whether there is an entry for the participant that was created from the same files and params"""
+        meta_path, data_path = self._paths(participant)
+        if not os.path.isfile(meta_path) or not os.path.isfile(data_path):
+            return False
+
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+        if meta['params'] != params or sorted(meta['sources'].keys()) != sorted(source_files):
+            return False
+
+        fingerprints = {path: file_fingerprint(path, meta['sources'][path]) for path in source_files}
+        if any(fingerprints[path]['sha1'] != meta['sources'][path]['sha1'] for path in source_files):
+            return False
+
+        # refresh mtimes so that the next run does not need to hash the files again
+        if fingerprints != meta['sources']:
+            meta['sources'] = fingerprints
+            self._write_meta(meta_path, meta)
+
+        return True
+
+    def read(self, participant):
+        """Reads an entry without any checks, use is_valid first"""
+        with open(self._paths(participant)[1], 'rb') as f:
+            return pickle.load(f)
+
+    def load(self, participant, source_files, params=None):
+        if not self.is_valid(participant, source_files, params):
+            return None
+        return self.read(participant)
+
+    def store(self, participant, source_files, data, params=None):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        meta_path, data_path = self._paths(participant)
+        meta = {'params': params, 'sources': {path: file_fingerprint(path) for path in source_files}}
+
+        with open(f'{data_path}.tmp', 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f'{data_path}.tmp', data_path)
+        self._write_meta(meta_path, meta)
+
+    @staticmethod
+    def _write_meta(meta_path, meta):
+        with open(f'{meta_path}.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(f'{meta_path}.tmp', meta_path)
@@ -0,0 +1,134 @@
+"""
+Cost estimates of trial-level jobs, used to schedule the longest jobs first: the duration of the webcam video (from
+its container metadata) times the seconds per frame the stage needed in earlier runs. The measured rates are smoothed
+over all finished trials (see telemetry.trial) and persisted in COST_MODEL_PATH, so the estimates improve over time.
+"""
+
+import os
+import json
+import fcntl
+import subprocess
+from contextlib import contextmanager
+
+import settings
+
+# seconds per frame of stages that were not measured yet, only their ratio matters for the ordering
+DEFAULT_SECONDS_PER_FRAME = {'transcode': 0.002, 'icatcher': 0.05}
+DEFAULT_TRACKER_SECONDS_PER_FRAME = 0.03
+
+
+def probe_duration(path):
+    """Duration of a video in seconds according to its container, None if the container does not store it"""
+    result = subprocess.run(["ffprobe", "-v", "error", "-show_entries",
+                             "format=duration", "-of",
+                             "default=noprint_wrappers=1:nokey=1", path],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL,
+                            text=True)
+    try:
+        return float(result.stdout.splitlines()[-1])
+    except (ValueError, IndexError):  # e.g. 'N/A' for webm files recorded in the browser
+        return None
+
+
+class CostModel:
+
+    def __init__(self, path=None):
+        self.path = path or settings.COST_MODEL_PATH
+        self.seconds_per_frame = dict()  # stage -> smoothed seconds per frame
+        self.durations = dict()  # video path -> [size, mtime, duration], so unchanged videos are not probed again
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as f:
+                model = json.load(f)
+            self.seconds_per_frame = model['seconds_per_frame']
+            self.durations = model['durations']
+
+    @contextmanager
+    def _lock(self):
+        """Serializes reading, merging and writing the model file between the processes of all workers"""
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        with open(f'{self.path}.lock', 'w') as lock_file:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+    def _merge(self):
+        """Picks up what other processes saved in the meantime, their rates are never older than the ones in memory"""
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as f:
+                model = json.load(f)
+            self.seconds_per_frame.update(model['seconds_per_frame'])
+            self.durations = {**model['durations'], **self.durations}
+
+    def _write(self):
+        # the file is replaced atomically, so that it can be loaded without taking the lock
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'seconds_per_frame': self.seconds_per_frame, 'durations': self.durations}, f, indent=1)
+        os.replace(temp_path, self.path)
+
+    def save(self):
+        with self._lock():
+            self._merge()
+            self._write()
+
+    def duration(self, path):
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        cached = self.durations.get(key)
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime]:
+            return cached[2]
+
+        duration = probe_duration(path)
+        self.durations[key] = [stat.st_size, stat.st_mtime, duration]
+        return duration
+
+    def trial_duration(self, participant, stimulus):
+        """
+        Duration of the webcam video of a trial: the transcoded video, the original recording or, if neither is
+        available or has a duration, the presentation duration of the stimulus
+        """
+        for path in [f'{settings.WEBCAM_MP4_DIR}/{participant}_{stimulus}.mp4',
+                     f'{settings.DATA_DIR}/{participant}_{stimulus}.webm']:
+            if os.path.isfile(path):
+                duration = self.duration(path)
+                if duration:
+                    return duration
+        return settings.STIMULI[stimulus]['presentation_duration']
+
+    def rate(self, stage):
+        if stage in self.seconds_per_frame:
+            return self.seconds_per_frame[stage]
+        return DEFAULT_SECONDS_PER_FRAME.get(stage, DEFAULT_TRACKER_SECONDS_PER_FRAME)
+
+    def estimate(self, stage, participant, stimulus):
+        """Estimated seconds a stage (transcode or the name of a tracker) needs for a trial"""
+        return self.trial_duration(participant, stimulus) * settings.TARGET_FPS * self.rate(stage)
+
+    def record(self, stage, frames, seconds):
+        """Updates the seconds per frame of a stage with a finished trial and saves the model"""
+        if frames <= 0:
+            return
+
+        with self._lock():
+            self._merge()
+            measured = seconds / frames
+            previous = self.seconds_per_frame.get(stage)
+            self.seconds_per_frame[stage] = measured if previous is None else \
+                previous + settings.COST_MODEL_SMOOTHING * (measured - previous)
+            self._write()
+
+
+_model = None
+
+
+def get():
+    """The cost model of this process, loaded on first use"""
+    global _model
+    if _model is None:
+        _model = CostModel()
+    return _model
@@ -0,0 +1,27 @@
+"""
+Named ffmpeg encoding profiles (ENCODING_PROFILES in settings.py). Every ffmpeg call of the pipeline selects the
+profile that fits what the video is used for instead of relying on ffmpeg's defaults.
+"""
+
+import subprocess
+
+import settings
+
+
+def keeps_audio(profile):
+    return settings.ENCODING_PROFILES[profile]['audio'] is not None
+
+
+def output_args(profile):
+    """ffmpeg output options of a profile, audio is dropped if the profile does not keep it"""
+    options = settings.ENCODING_PROFILES[profile]
+    return options['video'] + (options['audio'] if keeps_audio(profile) else ['-an'])
+
+
+def has_audio(path):
+    result = subprocess.run(["ffprobe", "-v", "error", "-select_streams", "a",
+                             "-show_entries", "stream=index", "-of", "csv=p=0", path],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL,
+                            text=True)
+    return result.stdout.strip() != ''
@@ -0,0 +1,186 @@
+import os
+import json
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import settings
+
+
+class GazeCube:
+    """
+    Dense representation of the resampled data of a tracker. Every measure is stored as a float32 array shaped
+    (participant, stimulus, time bin), with NaN wherever a trial has no data (excluded trials, time bins after the
+    end of shorter stimuli).
+    Categorical hit columns are encoded as 1.0 (target), 0.0 (distractor) and NaN (none), so that means over a
+    window directly give the proportion of target looking.
+    """
+
+    HIT_MEASURES = ['hit', 'aoi_hit', 'side_hit']
+    HIT_CODES = {'target': 1.0, 'distractor': 0.0}
+    FLAG_MEASURES = ['outside', 'calibration_failure']
+    NUMERIC_MEASURES = ['x', 'y', 'conf', 'sampling_rate', 'trial']
+
+    AXES = {'participant': 0, 'stimulus': 1, 't': 2}
+
+    def __init__(self, participants, stimuli, measures, t=None, arrays=None, path=None):
+        self.participants = list(participants)
+        self.stimuli = list(stimuli)
+        self.participant_index = {p: i for i, p in enumerate(self.participants)}
+        self.stimulus_index = {s: i for i, s in enumerate(self.stimuli)}
+
+        if t is None:
+            # a cube without any stimuli (e.g. all trials were excluded) still gets a valid time axis
+            max_duration_seconds = max([settings.STIMULI[s]['presentation_duration'] for s in self.stimuli], default=0)
+            t = np.arange(0, int(max_duration_seconds * 1000 + 1), int(1000 / settings.RESAMPLING_RATE))
+        self.t = np.asarray(t)
+        self.timestep = self.t[1] - self.t[0] if len(self.t) > 1 else 1
+
+        if arrays is None:
+            shape = (len(self.participants), len(self.stimuli), len(self.t))
+            if path is None:
+                arrays = {m: np.full(shape, np.nan, dtype=np.float32) for m in measures}
+            else:
+                # memory-mapped .npy files in the layout of save(path), so that the cube never has to fit into memory
+                if not os.path.exists(path):
+                    os.makedirs(path)
+                arrays = dict()
+                for m in measures:
+                    arrays[m] = np.lib.format.open_memmap(os.path.join(path, f'{m}.npy'), mode='w+',
+                                                          dtype=np.float32, shape=shape)
+                    arrays[m][...] = np.nan
+        self.arrays = arrays
+
+    @property
+    def measures(self):
+        return list(self.arrays.keys())
+
+    @classmethod
+    def measures_of(cls, data):
+        return [m for m in cls.NUMERIC_MEASURES + cls.FLAG_MEASURES + cls.HIT_MEASURES if m in data.columns]
+
+    @classmethod
+    def from_resampled(cls, data, measures=None):
+        participants = sorted(data['id'].unique())
+        present_stimuli = set(data['stimulus'].unique())
+        stimuli = [s for s in settings.stimuli if s in present_stimuli]
+
+        cube = cls(participants, stimuli, cls.measures_of(data) if measures is None else measures)
+        cube.fill(data)
+        return cube
+
+    @classmethod
+    def from_csv(cls, csv_path, measures=None, path=None):
+        """
+        Builds the cube from a csv file of resampled data (e.g. the one main.py --merge combines), which is read in
+        chunks of MERGE_CHUNK_ROWS rows: once for the participants and stimuli, once to fill the cube
+        """
+        dtype = {'id': str, 'stimulus': str}
+        participants, present_stimuli = set(), set()
+        for chunk in pd.read_csv(csv_path, usecols=['id', 'stimulus'], dtype=dtype, chunksize=settings.MERGE_CHUNK_ROWS):
+            participants.update(chunk['id'].unique())
+            present_stimuli.update(chunk['stimulus'].unique())
+        stimuli = [s for s in settings.stimuli if s in present_stimuli]
+
+        if measures is None:
+            measures = cls.measures_of(pd.read_csv(csv_path, nrows=0))
+        cube = cls(sorted(participants), stimuli, measures, path=path)
+        for chunk in pd.read_csv(csv_path, dtype=dtype, chunksize=settings.MERGE_CHUNK_ROWS):
+            cube.fill(chunk)
+        return cube
+
+    @classmethod
+    def from_partitions(cls, partitions, measures=None, path=None):
+        """
+        Builds the cube from a PartitionStore of resampled data, reading one partition at a time. With a path, the
+        arrays are memory-mapped files in that directory instead of being held in memory.
+        """
+        keys = partitions.keys()
+        participants = sorted(set(p for p, _ in keys))
+        present_stimuli = set(s for _, s in keys)
+        stimuli = [s for s in settings.stimuli if s in present_stimuli]
+
+        cube = None
+        for data in partitions.frames():
+            if cube is None:
+                cube = cls(participants, stimuli, cls.measures_of(data) if measures is None else measures, path=path)
+            cube.fill(data)
+
+        if cube is None:  # e.g. all trials were excluded
+            cube = cls(participants, stimuli, measures or [], path=path)
+        return cube
+
+    def fill(self, data):
+        """Writes the rows of a long-format resampled frame into the cube. Can be called once per partition."""
+        pi = data['id'].map(self.participant_index).to_numpy(dtype=np.int64)
+        si = data['stimulus'].map(self.stimulus_index).to_numpy(dtype=np.int64)
+        ti = np.rint((data['t'].to_numpy(dtype=np.float64) - self.t[0]) / self.timestep).astype(np.int64)
+
+        valid = (ti >= 0) & (ti < len(self.t))
+        pi, si, ti = pi[valid], si[valid], ti[valid]
+        for m, array in self.arrays.items():
+            array[pi, si, ti] = self._encode(m, data[m])[valid]
+
+    @classmethod
+    def _encode(cls, measure, column):
+        if measure in cls.HIT_MEASURES:
+            return column.astype(object).map(cls.HIT_CODES).to_numpy(dtype=np.float32)
+        if measure in cls.FLAG_MEASURES:
+            return np.where(column.isna(), np.nan, column.eq(True)).astype(np.float32)
+        return pd.to_numeric(column, errors='coerce').to_numpy(dtype=np.float32)
+
+    def _time_slice(self, start, end):
+        """Bins from start (inclusive) to end (exclusive), both in ms"""
+        return slice(None if start is None else int(np.searchsorted(self.t, start, side='left')),
+                     None if end is None else int(np.searchsorted(self.t, end, side='left')))
+
+    @staticmethod
+    def _label_indices(index, labels):
+        return [index[label] for label in ([labels] if isinstance(labels, str) else labels)]
+
+    def window(self, measure, participants=None, stimuli=None, start=None, end=None):
+        """
+        Returns the (participant, stimulus, time bin) array of a measure, restricted to the given participant and
+        stimulus labels and the time window [start, end) in ms. Without label restrictions, the result is a view.
+        """
+        sub = self.arrays[measure][:, :, self._time_slice(start, end)]
+        if participants is not None:
+            sub = sub[self._label_indices(self.participant_index, participants), :, :]
+        if stimuli is not None:
+            sub = sub[:, self._label_indices(self.stimulus_index, stimuli), :]
+        return sub
+
+    def aggregate(self, measure, over=('t',), func=np.nanmean, participants=None, stimuli=None, start=None, end=None):
+        """Aggregates a window over the given axes ('participant', 'stimulus', 't'), ignoring missing data"""
+        sub = self.window(measure, participants, stimuli, start, end)
+        with warnings.catch_warnings():
+            # all-NaN slices (e.g. excluded trials) are expected and simply stay NaN
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            return func(sub, axis=tuple(self.AXES[axis] for axis in over))
+
+    def save(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        for m, array in self.arrays.items():
+            array_path = os.path.join(path, f'{m}.npy')
+            if isinstance(array, np.memmap) and os.path.abspath(array.filename) == os.path.abspath(array_path):
+                array.flush()  # built in place by from_partitions
+            else:
+                np.save(array_path, array)
+
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'participants': self.participants,
+                       'stimuli': self.stimuli,
+                       't': self.t.tolist(),
+                       'measures': self.measures}, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Loads a saved cube. By default, the measure arrays are memory-mapped instead of read into memory."""
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+
+        arrays = {m: np.load(os.path.join(path, f'{m}.npy'), mmap_mode=mmap_mode) for m in meta['measures']}
+        return cls(meta['participants'], meta['stimuli'], meta['measures'], t=meta['t'], arrays=arrays)
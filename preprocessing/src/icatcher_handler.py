@@ -1,28 +1,36 @@
 import os
 import cv2
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 
 import settings
+from . import telemetry
 from .base_handler import GazecodingHandler
 
 
 class ICatcherHandler(GazecodingHandler):
 
+    # ICatcher reports the look from the webcams point of view
+    LOOK_FLIP = {'left': 'right', 'right': 'left'}
+
+    COLUMNS = ['id', 'stimulus', 'trial', 't', 'look', 'conf', 'hit']  # maybe refactor so that the colnames have a ssot?
+
     def __init__(self, name, participants, general_exclusions):
         super().__init__(name, participants, general_exclusions)
 
         self.webcam_dir = os.path.join(self.render_dir, 'webcam')
         self.raw_dir = os.path.join(self.render_dir, 'raw_results')
 
+        # lookup tables per opacity and output buffers per region shape, reused across all frames
+        self.dim_luts = dict()
+        self.dim_buffers = dict()
+
     def _preprocess(self):
 
-        if not os.path.exists(self.webcam_dir):
-            os.makedirs(self.webcam_dir)
-        if not os.path.exists(self.raw_dir):
-            os.makedirs(self.raw_dir)
+        self._create_dirs()
 
         # run icatcher
         for p in self.participants:
@@ -31,65 +39,158 @@ class ICatcherHandler(GazecodingHandler):
                 if not self._should_process_trial(p, s):
                     continue
 
-                input_file = f'{settings.WEBCAM_MP4_DIR}/{p}_{s}.mp4'
-                output_file_video = f'{self.webcam_dir}/{p}_{s}_output.mp4'
-                output_file_data = f'{self.raw_dir}/{p}_{s}.txt'
-                if os.path.isfile(input_file) and \
-                        (not os.path.isfile(output_file_video) or not os.path.isfile(output_file_data)):
-                    subprocess.Popen(['icatcher',
-                                      '--output_video_path',
-                                      self.webcam_dir,
-                                      '--output_annotation',
-                                      self.raw_dir,
-                                      #'--show_output',
-                                      '--use_fc_model',  # TODO report this one
-                                      input_file
-                                      ]).wait()
-
-        df_list = []
-        for p in self.participants:
-            for s in settings.stimuli_critical + ['calibration']:
-                data_file = f'{self.raw_dir}/{p}_{s}.txt'
-                if not os.path.isfile(data_file):
-                    continue
+                self._run_icatcher(p, s)
 
-                data = pd.read_csv(data_file, sep=",", header=None)
-                data.columns = ["frame", "look", "conf"]
+        with ThreadPoolExecutor(max_workers=settings.ICATCHER_READ_WORKERS) as executor:
+            results = self._iter_participant_data(
+                lambda p: [f'{self.raw_dir}/{p}_{s}.txt' for s in self._result_stimuli() if os.path.isfile(f'{self.raw_dir}/{p}_{s}.txt')],
+                self._load_participant_results,
+                executor,
+                settings.ICATCHER_READ_WORKERS
+            )
 
-                data['id'] = p
-                data['stimulus'] = s
-                data['trial'] = settings.STIMULI[s][f'{p.split("_")[-1]}_index']
-                data['t'] = data['frame'] * 1000 / settings.TARGET_FPS
-                df_list.append(data)
+            if settings.ICATCHER_WRITE_INTERIM_CSV:
+                results = self._write_interim_csv(results)
 
-        self.data = pd.concat(df_list)
-        self.data['look'] = self.data['look'].str.strip()
+            self._store_data(data[self.COLUMNS] for data in results)
 
-        # Flip the look so that variable represents the participants viewpoint, not the webcams
-        self.data.loc[self.data['look'] == 'left', 'look'] = 'tmp'
-        self.data.loc[self.data['look'] == 'right', 'look'] = 'left'
-        self.data.loc[self.data['look'] == 'tmp', 'look'] = 'right'
+        if self.data is not None:
+            self.data['look'] = self.data['look'].astype('category')
 
-        self.data = self.data.drop('frame', axis=1)\
-            .sort_values(['id', 'trial', 't']) \
-            .reset_index(drop=True)
+        self.backfill_cols += ['trial']
 
-        self.data['hit'] = self._side_to_hit(self.data['stimulus'], self.data['look'])
-        self.data.to_csv(f'{settings.OUT_DIR}/icatcher_data.csv', encoding='utf-8')
+    def _create_dirs(self):
+        os.makedirs(self.webcam_dir, exist_ok=True)
+        os.makedirs(self.raw_dir, exist_ok=True)
+
+    def _run_icatcher(self, p, s):
+        """
+        Runs ICatcher on the webcam video of a trial unless its results already exist. Returns False if the video exists
+        but the results are still missing afterwards.
+        """
+        input_file = f'{settings.WEBCAM_MP4_DIR}/{p}_{s}.mp4'
+        output_file_video = f'{self.webcam_dir}/{p}_{s}_output.mp4'
+        output_file_data = f'{self.raw_dir}/{p}_{s}.txt'
+        if os.path.isfile(input_file) and \
+                (not os.path.isfile(output_file_video) or not os.path.isfile(output_file_data)):
+            try:
+                with telemetry.trial(self.name, p, s) as counter:
+                    returncode = subprocess.Popen(['icatcher',
+                                                   '--output_video_path',
+                                                   self.webcam_dir,
+                                                   '--output_annotation',
+                                                   self.raw_dir,
+                                                   #'--show_output',
+                                                   '--use_fc_model',  # TODO report this one
+                                                   input_file
+                                                   ]).wait()
+                    if returncode != 0 or not os.path.isfile(output_file_video) or \
+                            not os.path.isfile(output_file_data):
+                        raise RuntimeError(f'ICatcher did not produce results for {p}_{s} (exit code {returncode})')
+
+                    # ICatcher annotates every frame with one line
+                    with open(output_file_data) as f:
+                        counter.add_frames(sum(1 for _ in f))
+            except RuntimeError as e:
+                # already counted as a failed trial, partial annotations must not be taken for finished ones
+                print(e)
+                if os.path.isfile(output_file_data):
+                    os.remove(output_file_data)
+                return False
+
+        return not os.path.isfile(input_file) or \
+            (os.path.isfile(output_file_video) and os.path.isfile(output_file_data))
+
+    def queue_jobs(self):
+        return [('icatcher', p, s) for p, s in self._trials_to_process() if self._has_webcam_video(p, s) and
+                (not os.path.isfile(f'{self.raw_dir}/{p}_{s}.txt') or
+                 not os.path.isfile(f'{self.webcam_dir}/{p}_{s}_output.mp4'))]
+
+    def run_job(self, kind, participant, stimulus):
+        if kind != 'icatcher':
+            return super().run_job(kind, participant, stimulus)
+
+        input_file = f'{settings.WEBCAM_MP4_DIR}/{participant}_{stimulus}.mp4'
+        if not os.path.isfile(input_file):
+            raise FileNotFoundError(f'The webcam video {input_file} is missing')
+
+        self._create_dirs()
+        if not self._run_icatcher(participant, stimulus):
+            raise RuntimeError(f'ICatcher did not produce results for {participant}_{stimulus}')
 
-        self.data = self.data[['id', 'stimulus', 'trial', 't', 'look', 'conf', 'hit']] # maybe refactor so that the colnames have a ssot?
-        self.backfill_cols += ['trial']
+    @staticmethod
+    def _write_interim_csv(results):
+        """Writes the unfiltered data of every participant to icatcher_data.csv while passing it on"""
+        row_offset = 0
+        header = True
+        with open(f'{settings.RESULTS_DIR}/icatcher_data.csv', 'w', encoding='utf-8', newline='') as f:
+            for data in results:
+                data = data.sort_values(['trial', 't'])
+                # continuous row numbers, like the index of the concatenated data
+                data.index = range(row_offset, row_offset + len(data.index))
+                data.to_csv(f, header=header)
+                row_offset += len(data.index)
+                header = False
+                yield data
 
     @staticmethod
-    def _paint_black_rect(fr, stimulus_name, side, opacity):
-        y, h = 0, int(settings.STIMULI[stimulus_name]['height'])
-        w = int(settings.STIMULI[stimulus_name]['width'] / 2.0)
-        x = 0 if side == 'left' else int(settings.STIMULI[stimulus_name]['width'] / 2.0)
+    def _result_stimuli():
+        return settings.stimuli_critical + ['calibration']
+
+    def _load_participant_results(self, p):
+        df_list = []
+        for s in self._result_stimuli():
+            data_file = f'{self.raw_dir}/{p}_{s}.txt'
+            if not os.path.isfile(data_file):
+                continue
+
+            data = pd.read_csv(data_file, sep=",", header=None, names=["frame", "look", "conf"],
+                               skipinitialspace=True, dtype={'look': 'category'})
+
+            data['id'] = p
+            data['stimulus'] = s
+            data['trial'] = settings.STIMULI[s][f'{p.split("_")[-1]}_index']
+            data['t'] = data['frame'] * 1000 / settings.TARGET_FPS
+            df_list.append(data)
+
+        data = pd.concat(df_list)
+        data['look'] = self._flip_looks(data['look'].astype('category'))
+
+        data = data.drop('frame', axis=1)
+        data['hit'] = self._side_to_hit(data['stimulus'], data['look'])
+        return data
+
+    def _flip_looks(self, look):
+        """
+        Strips the look labels and flips left and right so that the variable represents the participants viewpoint,
+        not the webcams. Only the categories get relabeled, the codes are remapped in a single vectorized step.
+        """
+        labels = [self.LOOK_FLIP.get(c.strip(), c.strip()) for c in look.cat.categories]
+        categories = sorted(set(labels))
+        code_mapping = np.array([categories.index(label) for label in labels] + [-1])
+
+        # missing values have the code -1, which indexes the appended -1 of the mapping
+        return pd.Categorical.from_codes(code_mapping[look.cat.codes.to_numpy()], categories)
+
+    def _dim_lut(self, opacity):
+        # equivalent to cv2.addWeighted(region, 1 - opacity, black, opacity, 1.0)
+        if opacity not in self.dim_luts:
+            values = np.arange(256, dtype=np.uint8).reshape(1, 256)
+            self.dim_luts[opacity] = cv2.addWeighted(values, 1 - opacity, np.zeros_like(values), opacity, 1.0)
+        return self.dim_luts[opacity]
+
+    def _paint_black_rect(self, fr, stimulus_name, side, opacity):
+        y, h = 0, int(settings.STIMULI[stimulus_name]['height'] * self.render_scale)
+        w = int(settings.STIMULI[stimulus_name]['width'] * self.render_scale / 2.0)
+        x = 0 if side == 'left' else w
 
         sub_img = fr[y:h, x:x + w]
-        black_rect = np.zeros(sub_img.shape, dtype=np.uint8)
-        res = cv2.addWeighted(sub_img, 1 - opacity, black_rect, opacity, 1.0)
-        fr[y:h, x:x + w] = res
+        if sub_img.shape not in self.dim_buffers:
+            self.dim_buffers[sub_img.shape] = np.empty(sub_img.shape, dtype=np.uint8)
+        buffer = self.dim_buffers[sub_img.shape]
+
+        cv2.LUT(sub_img, self._dim_lut(opacity), dst=buffer)
+        sub_img[...] = buffer
 
     def _render_frame(self, frame, index, data):
         is_valid_look = data['look'][index] == 'left' or data['look'][index] == 'right'
@@ -100,14 +201,19 @@ class ICatcherHandler(GazecodingHandler):
             self._paint_black_rect(frame, data['stimulus'][index], 'right', 0.5)
 
         if is_valid_look:
-            w = int(settings.STIMULI[data['stimulus'][index]]['width'] / 2.0)
-            h = int(settings.STIMULI[data['stimulus'][index]]['height'])
+            w = int(settings.STIMULI[data['stimulus'][index]]['width'] * self.render_scale / 2.0)
+            h = int(settings.STIMULI[data['stimulus'][index]]['height'] * self.render_scale)
             cv2.circle(frame, (int(w / 2 if data['look'][index] == 'left' else w / 2 * 3), int(h / 2)),
-                       radius=10, color=(0, 0, 255), thickness=-1)
+                       radius=max(1, round(10 * self.render_scale)), color=(0, 0, 255), thickness=-1)
 
-    def _render_post_loop(self, input_path, output_path, participant, stimulus):
+    def _render_post_loop(self, input_path, output_path, participant, stimulus, preview=False):
         icatcher_webcam_path = f'{self.webcam_dir}/{participant}_{stimulus}_output.mp4'
-        self._overlay_webcam(input_path, output_path, icatcher_webcam_path)
+        if preview:
+            # the input is already downscaled, so the webcam gets scaled down accordingly
+            self._overlay_webcam(input_path, output_path, icatcher_webcam_path, profile='preview',
+                                 width=self._webcam_width(preview))
+        else:
+            self._overlay_webcam(input_path, output_path, icatcher_webcam_path)
 
     def _render_frame_joint(self, frame, t, data):
         timepoint_data = data[(data['t'] == int(t)) & ((data['look'] == 'left') | (data['look'] == 'right'))].reset_index(
@@ -120,8 +226,9 @@ class ICatcherHandler(GazecodingHandler):
             self._paint_black_rect(frame, timepoint_data['stimulus'][0], 'right', left_per)
 
             def put_percentage(fr, x, percentage):
-                cv2.putText(fr, f'{(int(percentage * 100)):02d}%', (int(x), 50), cv2.FONT_HERSHEY_SIMPLEX, 1.5,
-                            (0, 0, 255), 2, cv2.LINE_AA)
+                scale = self.render_scale
+                cv2.putText(fr, f'{(int(percentage * 100)):02d}%', (int(x * scale), int(50 * scale)),
+                            cv2.FONT_HERSHEY_SIMPLEX, 1.5 * scale, (0, 0, 255), max(1, round(2 * scale)), cv2.LINE_AA)
 
             put_percentage(frame, 30, left_per)
             put_percentage(frame, settings.STIMULI[timepoint_data['stimulus'][0]]['width'] - 130, 1 - left_per)
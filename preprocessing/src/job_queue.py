@@ -0,0 +1,244 @@
+"""
+SQLite-backed queue of trial-level jobs (transcode, ICatcher, OWLET). main.py --enqueue fills it, any number of
+main.py --worker processes, on one host or on several hosts sharing the filesystem, claim jobs until it is drained.
+
+Jobs run in stages: a job is only claimed once the lower-stage jobs it depends on are finished, i.e. the transcode of
+the same trial and the earlier jobs of the same tracker and participant (e.g. the OWLET calibration). Workers
+heartbeat while running a job, jobs of workers that stopped heartbeating are claimed again and failed jobs are retried
+up to JOB_MAX_ATTEMPTS times. Jobs that depend on a failed job stay pending until it is enqueued again.
+"""
+
+import os
+import time
+import socket
+import sqlite3
+import threading
+import traceback
+from contextlib import contextmanager
+
+import settings
+from . import telemetry
+
+# jobs that are not tied to a tracker (transcode) have this handler name
+NO_HANDLER = ''
+
+STAGES = {'transcode': 0, 'icatcher': 1, 'owlet_calibration': 1, 'owlet': 2}
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY,
+        kind TEXT NOT NULL,
+        handler TEXT NOT NULL,
+        participant TEXT NOT NULL,
+        stimulus TEXT NOT NULL,
+        stage INTEGER NOT NULL,
+        priority REAL NOT NULL DEFAULT 0,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        worker TEXT,
+        heartbeat REAL,
+        error TEXT,
+        UNIQUE (kind, handler, participant, stimulus)
+    )""",
+    "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, priority, id)",
+    "CREATE INDEX IF NOT EXISTS jobs_participant ON jobs (participant, stage)",
+]
+
+
+def depends_on(job, dependency):
+    """Whether a (kind, handler, participant, stimulus) job waits for another one, the same rule as in claim"""
+    kind, handler, participant, stimulus = job
+    d_kind, d_handler, d_participant, d_stimulus = dependency
+    return d_participant == participant and STAGES[d_kind] < STAGES[kind] and \
+        (d_handler == handler or (d_handler == NO_HANDLER and d_stimulus == stimulus))
+
+
+def critical_path_priorities(jobs, costs):
+    """
+    Priorities for longest-job-first scheduling: the estimated cost of a job plus the most expensive chain of jobs
+    waiting for it. A short transcode that a long OWLET trial depends on is thereby claimed early.
+    """
+    by_participant = dict()
+    for i, job in enumerate(jobs):
+        by_participant.setdefault(job[2], []).append(i)
+
+    priorities = list(costs)
+    for indices in by_participant.values():
+        # later stages first, so that the priorities of the dependent jobs are final when they are added
+        for i in sorted(indices, key=lambda i: STAGES[jobs[i][0]], reverse=True):
+            dependents = [priorities[j] for j in indices if depends_on(jobs[j], jobs[i])]
+            priorities[i] = costs[i] + max(dependents, default=0)
+    return priorities
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class JobQueue:
+
+    def __init__(self, path=None):
+        self.path = path or settings.JOB_QUEUE_PATH
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        # transactions are managed explicitly, so that a claim can take the write lock before it reads
+        self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        with self._transaction():
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+
+    def close(self):
+        self.connection.close()
+
+    @contextmanager
+    def _transaction(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+    def enqueue(self, jobs, priorities=None):
+        """
+        Adds (kind, handler, participant, stimulus) jobs that are not queued yet, updates the priorities of queued
+        ones and puts failed jobs back into the queue. Done jobs that are passed again (their results are missing,
+        e.g. because they were deleted) are queued again as well. Jobs with a higher priority are claimed first.
+        Returns the number of added jobs.
+        """
+        priorities = priorities or [0] * len(jobs)
+        with self._transaction():
+            count = self.connection.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+            self.connection.executemany(
+                """INSERT INTO jobs (kind, handler, participant, stimulus, stage, priority) VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (kind, handler, participant, stimulus) DO UPDATE SET priority = excluded.priority,
+                       status = CASE WHEN status = 'done' THEN 'pending' ELSE status END,
+                       attempts = CASE WHEN status = 'done' THEN 0 ELSE attempts END""",
+                [(kind, handler, p, s, STAGES[kind], priority) for (kind, handler, p, s), priority in zip(jobs, priorities)])
+            added = self.connection.execute("SELECT COUNT(*) FROM jobs").fetchone()[0] - count
+            self.connection.execute(
+                "UPDATE jobs SET status = 'pending', attempts = 0, error = NULL WHERE status = 'failed'")
+        return added
+
+    def _release_stale(self):
+        """Puts the jobs of workers that stopped heartbeating (crashed, killed, lost their host) back into the queue"""
+        self.connection.execute(
+            """UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, worker = NULL,
+                   error = 'worker ' || worker || ' stopped heartbeating'
+               WHERE status = 'running' AND heartbeat < ?""",
+            (settings.JOB_MAX_ATTEMPTS, time.time() - settings.JOB_TIMEOUT))
+
+    def claim(self, worker):
+        """Atomically marks the next runnable job as running by worker and returns it, None if there is none"""
+        with self._transaction():
+            self._release_stale()
+            row = self.connection.execute(
+                """SELECT * FROM jobs AS j WHERE status = 'pending' AND NOT EXISTS (
+                       SELECT 1 FROM jobs AS d
+                       WHERE d.participant = j.participant AND d.stage < j.stage
+                           AND (d.handler = j.handler OR (d.handler = ? AND d.stimulus = j.stimulus))
+                           AND d.status != 'done')
+                   ORDER BY priority DESC, id LIMIT 1""", (NO_HANDLER,)).fetchone()
+            if row is None:
+                return None
+
+            self.connection.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, heartbeat = ? WHERE id = ?",
+                (worker, time.time(), row['id']))
+
+        job = dict(row)
+        job['attempts'] += 1
+        return job
+
+    def heartbeat(self, job_id, worker):
+        with self._transaction():
+            self.connection.execute("UPDATE jobs SET heartbeat = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                                    (time.time(), job_id, worker))
+
+    def complete(self, job_id, worker):
+        with self._transaction():
+            self.connection.execute("UPDATE jobs SET status = 'done', error = NULL WHERE id = ? AND worker = ?",
+                                    (job_id, worker))
+
+    def fail(self, job_id, worker, error):
+        """Puts a failed job back into the queue, or marks it as failed once it ran out of attempts"""
+        with self._transaction():
+            self.connection.execute(
+                """UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, worker = NULL,
+                       error = ?
+                   WHERE id = ? AND worker = ?""",
+                (settings.JOB_MAX_ATTEMPTS, error, job_id, worker))
+
+    def release(self, job_id, worker):
+        """Puts a job back into the queue without counting the attempt, e.g. when the worker gets interrupted"""
+        with self._transaction():
+            self.connection.execute(
+                """UPDATE jobs SET status = 'pending', attempts = attempts - 1, worker = NULL
+                   WHERE id = ? AND worker = ? AND status = 'running'""", (job_id, worker))
+
+    def counts(self):
+        """Number of jobs per status"""
+        rows = self.connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+
+class Heartbeat:
+    """Updates the heartbeat of a running job from a background thread (with a connection of its own)"""
+
+    def __init__(self, path, job_id, worker):
+        self.path = path
+        self.job_id = job_id
+        self.worker = worker
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        queue = JobQueue(self.path)
+        try:
+            while not self.stopped.wait(settings.JOB_HEARTBEAT_INTERVAL):
+                queue.heartbeat(self.job_id, self.worker)
+        finally:
+            queue.close()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+
+def work(queue, run_job, worker=None):
+    """
+    Claims and runs jobs with run_job(job) until no job is running and none of the pending ones can be claimed, the
+    ones left pending depend on failed jobs. Idle workers wait for jobs that depend on running ones. Returns the number
+    of jobs per status at the end.
+    """
+    worker = worker or worker_name()
+    while True:
+        telemetry.queue(queue.counts())
+        job = queue.claim(worker)
+        if job is None:
+            counts = queue.counts()
+            if counts.get('running', 0) == 0:
+                return counts
+            time.sleep(settings.JOB_POLL_INTERVAL)
+            continue
+
+        print(f'[{worker}] {job["kind"]} {job["participant"]}_{job["stimulus"]} (attempt {job["attempts"]})')
+        try:
+            with Heartbeat(queue.path, job['id'], worker):
+                run_job(job)
+        except Exception as e:
+            # failures of the trial itself are counted by telemetry.trial
+            traceback.print_exc()
+            queue.fail(job['id'], worker, f'{type(e).__name__}: {e}')
+        except BaseException:
+            queue.release(job['id'], worker)
+            raise
+        else:
+            queue.complete(job['id'], worker)
@@ -4,8 +4,9 @@ import subprocess
 import pandas as pd
 
 import settings
+from . import telemetry
+from . import encoding
 from .base_xy_handler import EyetrackingHandler
-from .owlet_slim.owlet import OWLET
 
 # TODO
 """
@@ -32,6 +33,12 @@ class OWLETHandler(EyetrackingHandler):
         self.calibrate = calibrate
         self.raw_dir = os.path.join(self.render_dir, 'raw_results')
 
+    def _get_trial_aggregations(self):
+        aggregations = super()._get_trial_aggregations()
+        if self.calibrate:
+            aggregations['calibration_failure'] = ('calibration_failure', 'any')
+        return aggregations
+
     def _get_exclusion_functions(self):
         parent_functions = super()._get_exclusion_functions()
 
@@ -40,14 +47,12 @@ class OWLETHandler(EyetrackingHandler):
 
         owlet_exclusion_functions = []
         if self.calibrate:
-            def exclude_no_calib(data):
-                return self.general_exclusions[(self.general_exclusions['excluded'] == 'x') & (self.general_exclusions['stimulus'] == 'calibration')][
-                    ['id']].drop_duplicates(keep='first').reset_index(drop=True).merge(pd.DataFrame({'stimulus': list(set(settings.stimuli) - set(settings.STIMULUS_BLACKLIST[self.name]))}), how='cross')
+            def exclude_no_calib(trials):
+                no_calib = self.general_exclusions[(self.general_exclusions['excluded'] == 'x') & (self.general_exclusions['stimulus'] == 'calibration')]['id']
+                return trials['id'].isin(no_calib)
 
-            def exclude_calib_failed(data):
-                exclude_tracking = data[data['calibration_failure']][
-                    ['id', 'stimulus']].drop_duplicates(keep='first').reset_index(drop=True)
-                return exclude_tracking
+            def exclude_calib_failed(trials):
+                return trials['calibration_failure'].eq(True)
 
             owlet_exclusion_functions += [(exclude_no_calib, '_no_calib_owlet'), (exclude_calib_failed, '_calib_failed_ow')]
 
@@ -85,26 +90,18 @@ class OWLETHandler(EyetrackingHandler):
 
     def _preprocess(self):
 
-        # Prepare videos by cropping webcam videos to owlets preferred
-        if not os.path.exists(settings.CROPPED_WEBCAM_MP4_DIR):
-            os.makedirs(settings.CROPPED_WEBCAM_MP4_DIR)
-
+        # Prepare videos by cropping webcam videos to owlets preferred aspect ratio - only needed if OWLET
+        # does not crop the decoded frames itself or if you want to inspect the cropped videos
         if settings.RENDER_WEBCAM_VIDEOS_16_9:
             for p in self.participants:
                 for s in settings.stimuli:
-                    webcam_path = f'{settings.WEBCAM_MP4_DIR}/{p}_{s}.mp4'
-                    cropped_webcam_path = f'{settings.CROPPED_WEBCAM_MP4_DIR}/{p}_{s}.mp4'
-                    if os.path.isfile(webcam_path) and not os.path.isfile(cropped_webcam_path):
-                        subprocess.Popen(['ffmpeg', '-y',
-                                          '-i', webcam_path,
-                                          '-filter:v',
-                                          'crop=iw:9*iw/16',
-                                          cropped_webcam_path,
-                                          ]).wait()
+                    self._crop_webcam_video(p, s)
 
         if not os.path.exists(self.raw_dir):
             os.makedirs(self.raw_dir)
 
+        video_dir, crop = self._video_source()
+
         for p in self.participants:
             owlet = None
             for s in settings.stimuli:
@@ -112,50 +109,149 @@ class OWLETHandler(EyetrackingHandler):
                 if not self._should_process_trial(p, s):
                     continue
 
-                input_file = f'{settings.CROPPED_WEBCAM_MP4_DIR}/{p}_{s}.mp4'
+                input_file = f'{video_dir}/{p}_{s}.mp4'
                 output_file_data = f'{self.raw_dir}/{p}_{s}.csv'
                 if os.path.isfile(input_file) and not os.path.isfile(output_file_data):
 
                     if owlet is None:
-                        owlet = OWLET(settings.SCREEN_WIDTH, settings.SCREEN_HEIGHT)
-                        if self.calibrate:
-                            calibration_file = f'{settings.CROPPED_WEBCAM_MP4_DIR}/{p}_calibration.mp4'
-                            if not os.path.isfile(calibration_file):
-                                print(f'No calibration file found for {p}, skipping')
-                                break
-                            print(f'Calibrating {p}')
-                            owlet.calibrate_gaze(calibration_file, show_output=False)
-
-                    print(f'Processing {input_file}')
-                    owlet.process_video(input_file, output_file_data)
-
-        df_list = []
-        for p in self.participants:
-            for s in settings.stimuli:
-                data_file = f'{self.raw_dir}/{p}_{s}.csv'
-                if not os.path.isfile(data_file):
-                    continue
+                        owlet = self._create_owlet()
+                        if self.calibrate and not self._calibrate(owlet, p, video_dir, crop):
+                            break
 
-                data = pd.read_csv(data_file)
-                if not self.calibrate:
-                    data['calibration_failure'] = False
-                data['stimulus'] = s
-                data['window_height'] = 540
-                data['window_width'] = 960
-                data = data.apply(self._translate_coordinates_df, axis=1)
+                    self._process_video(owlet, p, s, input_file, output_file_data, crop)
 
-                data['id'] = p
-                data['trial'] = settings.STIMULI[s][f'{p.split("_")[-1]}_index']
+        self._store_data(self._iter_participant_data(
+            lambda p: [f'{self.raw_dir}/{p}_{s}.csv' for s in settings.stimuli if os.path.isfile(f'{self.raw_dir}/{p}_{s}.csv')],
+            self._load_participant_results
+        ))
 
-                data['side'] = [None if x is None else ('left' if x < settings.STIMULI[s]['width'] / 2.0 else 'right') for x in data['x']]
-                df_list.append(data)
-
-        self.data = pd.concat(df_list)\
-            .sort_values(['id', 'trial', 't']) \
-            .reset_index(drop=True)
+        self.backfill_cols += ['trial']
 
-        self.data['aoi'] = self._xy_to_aoi_vec(self.data['x'], self.data['y'])
-        self.data['aoi_hit'] = self._side_to_hit(self.data['stimulus'], self.data['aoi'])  # target vs distractor
-        self.data['side_hit'] = self._side_to_hit(self.data['stimulus'], self.data['side'])  # target vs distractor
+    @staticmethod
+    def _video_source():
+        if settings.OWLET_CROP_ON_THE_FLY:
+            return settings.WEBCAM_MP4_DIR, (16, 9)
+        return settings.CROPPED_WEBCAM_MP4_DIR, None
 
-        self.backfill_cols += ['trial']
+    @staticmethod
+    def _crop_webcam_video(p, s):
+        if not os.path.exists(settings.CROPPED_WEBCAM_MP4_DIR):
+            os.makedirs(settings.CROPPED_WEBCAM_MP4_DIR, exist_ok=True)
+
+        webcam_path = f'{settings.WEBCAM_MP4_DIR}/{p}_{s}.mp4'
+        cropped_webcam_path = f'{settings.CROPPED_WEBCAM_MP4_DIR}/{p}_{s}.mp4'
+        if os.path.isfile(webcam_path) and not os.path.isfile(cropped_webcam_path):
+            subprocess.Popen(['ffmpeg', '-y',
+                              '-i', webcam_path,
+                              '-filter:v',
+                              'crop=iw:9*iw/16',
+                              ] + encoding.output_args('analysis') + [
+                              cropped_webcam_path,
+                              ]).wait()
+
+    @staticmethod
+    def _create_owlet():
+        # dlib and its face landmark model only get loaded once a video actually needs processing
+        from .owlet_slim.owlet import OWLET
+
+        return OWLET(settings.SCREEN_WIDTH, settings.SCREEN_HEIGHT, decoder=settings.OWLET_DECODER,
+                     checkpoint_interval=settings.OWLET_CHECKPOINT_INTERVAL,
+                     face_detector=settings.OWLET_FACE_DETECTOR)
+
+    def _calibrate(self, owlet, p, video_dir, crop):
+        """
+        Calibrates OWLET for a participant, or loads the calibration saved by an earlier run or calibration job.
+        Returns False if there is no calibration video.
+        """
+        calibration_path = f'{self.raw_dir}/{p}_calibration.pkl'
+        if os.path.isfile(calibration_path):
+            owlet.load_calibration(calibration_path)
+            return True
+
+        calibration_file = f'{video_dir}/{p}_calibration.mp4'
+        if not os.path.isfile(calibration_file):
+            print(f'No calibration file found for {p}, skipping')
+            return False
+
+        print(f'Calibrating {p}')
+        with telemetry.trial(f'{self.name}_calibration', p, 'calibration') as counter:
+            owlet.calibrate_gaze(calibration_file, show_output=False, crop=crop,
+                                 analysis_fps=settings.OWLET_CALIBRATION_FPS, progress=counter.add_frames)
+        if owlet.calibration_failure:
+            telemetry.failure(f'{self.name}_calibration')
+        owlet.save_calibration(calibration_path)
+        return True
+
+    def queue_jobs(self):
+        jobs = []
+        for p, s in self._trials_to_process():
+            if os.path.isfile(f'{self.raw_dir}/{p}_{s}.csv') or not self._has_webcam_video(p, s):
+                continue
+
+            # the trials of a participant wait for its calibration job
+            calibration_job = ('owlet_calibration', p, 'calibration')
+            if self.calibrate and not os.path.isfile(f'{self.raw_dir}/{p}_calibration.pkl'):
+                if not self._has_webcam_video(p, 'calibration'):
+                    continue  # skipped without calibration, like in _preprocess
+                if calibration_job not in jobs:
+                    jobs.append(calibration_job)
+            jobs.append(('owlet', p, s))
+        return jobs
+
+    def run_job(self, kind, participant, stimulus):
+        if kind not in ['owlet_calibration', 'owlet']:
+            return super().run_job(kind, participant, stimulus)
+
+        os.makedirs(self.raw_dir, exist_ok=True)
+        video_dir, crop = self._video_source()
+        if settings.RENDER_WEBCAM_VIDEOS_16_9:
+            self._crop_webcam_video(participant, stimulus)
+
+        owlet = self._create_owlet()
+        if kind == 'owlet_calibration':
+            if not self._calibrate(owlet, participant, video_dir, crop):
+                raise FileNotFoundError(f'The calibration video of {participant} is missing')
+            return
+
+        input_file = f'{video_dir}/{participant}_{stimulus}.mp4'
+        output_file_data = f'{self.raw_dir}/{participant}_{stimulus}.csv'
+        if os.path.isfile(output_file_data):
+            return
+        if not os.path.isfile(input_file):
+            raise FileNotFoundError(f'The webcam video {input_file} is missing')
+        if self.calibrate and not self._calibrate(owlet, participant, video_dir, crop):
+            raise FileNotFoundError(f'The calibration video of {participant} is missing')
+
+        self._process_video(owlet, participant, stimulus, input_file, output_file_data, crop)
+
+    def _process_video(self, owlet, p, s, input_file, output_file_data, crop):
+        print(f'Processing {input_file}')
+        with telemetry.trial(self.name, p, s) as counter:
+            owlet.process_video(input_file, output_file_data, crop=crop, progress=counter.add_frames)
+
+    def _load_participant_results(self, p):
+        df_list = []
+        for s in settings.stimuli:
+            data_file = f'{self.raw_dir}/{p}_{s}.csv'
+            if not os.path.isfile(data_file):
+                continue
+
+            data = pd.read_csv(data_file)
+            if not self.calibrate:
+                data['calibration_failure'] = False
+            data['stimulus'] = s
+            data['window_height'] = 540
+            data['window_width'] = 960
+            data = data.apply(self._translate_coordinates_df, axis=1)
+
+            data['id'] = p
+            data['trial'] = settings.STIMULI[s][f'{p.split("_")[-1]}_index']
+
+            data['side'] = [None if x is None else ('left' if x < settings.STIMULI[s]['width'] / 2.0 else 'right') for x in data['x']]
+            df_list.append(data)
+
+        data = pd.concat(df_list)
+        data['aoi'] = self._xy_to_aoi_vec(data['x'], data['y'])
+        data['aoi_hit'] = self._side_to_hit(data['stimulus'], data['aoi'])  # target vs distractor
+        data['side_hit'] = self._side_to_hit(data['stimulus'], data['side'])  # target vs distractor
+        return data
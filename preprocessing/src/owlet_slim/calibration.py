@@ -26,16 +26,17 @@ import cv2
 import numpy as np
 
 from .gaze_tracking import GazeTracking
+from .video import open_video
 
 
 class LookingCalibration(object):
 
-    def __init__(self, show_output):
+    def __init__(self, show_output, face_detector='dlib_hog'):
         self.invert_calib_order = False
         self.frame = None
         self.eye_left = None
         self.eye_right = None
-        self.gaze = GazeTracking(2.7, 4, 1, 1, 1) # eventually replace this with means from babies
+        self.gaze = GazeTracking(2.7, 4, 1, 1, 1, face_detector) # eventually replace this with means from babies
         self.hor_ratios = []
         self.hor_ratios2 = []
         self.left_ratios = []
@@ -50,15 +51,14 @@ class LookingCalibration(object):
         self.timestamp = 0
         self.show_output = show_output
 
-    def calibrate_eyes(self, file):
-        video = cv2.VideoCapture(file, )
+    def calibrate_eyes(self, file, crop=None, decoder='cv2'):
+        # frames come out of the reader already cropped and resized to 960x540
+        video = open_video(file, decoder, crop=crop, gray=decoder == 'ffmpeg')
         success, frame = video.read()
 
         while success:
 
-            self.timestamp = video.get(cv2.CAP_PROP_POS_MSEC)
-
-            frame = cv2.resize(frame, (960, 540))
+            self.timestamp = video.position_msec()
 
             # We send this frame to GazeTracking to analyze it
             self.gaze.refresh(frame)
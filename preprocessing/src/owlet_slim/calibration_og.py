@@ -30,18 +30,18 @@ Assumptions: this code only works when the mom is higher than the baby
 
 import cv2
 from .gaze_tracking import GazeTracking
+from .video import open_video
 import numpy as np
-import math
 
 
 class LookingCalibration(object):
 
-    def __init__(self, show_output, cwd):
+    def __init__(self, show_output, cwd, face_detector='dlib_hog'):
         self.invert_calib_order = False
         self.frame = None
         self.eye_left = None
         self.eye_right = None
-        self.gaze = GazeTracking(2.7, 4, 1, 1, 1) # eventually replace this with means from babies
+        self.gaze = GazeTracking(2.7, 4, 1, 1, 1, face_detector) # eventually replace this with means from babies
         
        # self.videoFile =  None #"Natalie_calib.mp4"
        # self.cap3 =  None   # capturing the video from the given path
@@ -62,26 +62,40 @@ class LookingCalibration(object):
         self.cwd = cwd
         
 
-    def calibrate_eyes(self, file, calib_starttime):
-        cap3 = cv2.VideoCapture(file)
+    def calibrate_eyes(self, file, calib_starttime, crop=None, decoder='cv2', analysis_fps=None, progress=None):
+        # frames come out of the reader already cropped and resized to 960x540
+        cap3 = open_video(file, decoder, crop=crop, gray=decoder == 'ffmpeg', analysis_fps=analysis_fps)
         hor_look = 2
         ver_look = 2
         
-        frameId = cap3.get(1) #current frame number
+        frameId = 0 #current frame number
         
-        fps = cap3.get(5)
-                
-        frameval = math.ceil(fps) // 20  # This is the only line changed from the original to fit our video requirements
+        fps = cap3.fps
+
+        # The original computed frameval = math.ceil(fps) // 20 here, but never advanced frameId, so every frame got
+        # analysed. That stays the default; with analysis_fps, only every frameval-th frame gets analysed and the
+        # frames in between are only grabbed, without being retrieved, resized or analysed (the ffmpeg reader does
+        # not even receive them).
+        frameval = cap3.frame_step
         
-        while (cap3.isOpened() and self.timestamp < (calib_starttime + 25000)):
+        while (cap3.is_opened() and self.timestamp < (calib_starttime + 25000)):
+            if frameId % frameval != 0:
+                ret = cap3.grab()
+                self.timestamp = cap3.position_msec()
+                frameId += 1
+                if not ret:
+                    break
+                if progress is not None:
+                    progress(1)
+                continue
+
             ret, frame = cap3.read()
             start = calib_starttime - 1000
             end = calib_starttime + 25000
-            self.timestamp = cap3.get(cv2.CAP_PROP_POS_MSEC)
+            self.timestamp = cap3.position_msec()
             if (ret != True):
                 break
             if frameId % frameval == 0:
-                frame = cv2.resize(frame, (960,540))
 
             # We send this frame to GazeTracking to analyze it
                 self.gaze.refresh(frame)
@@ -126,6 +140,9 @@ class LookingCalibration(object):
                 if self.show_output:
                     cv2.putText(frame, "Calibrating...", (20, 30), cv2.FONT_HERSHEY_DUPLEX, 0.9, (255, 255, 0), 1)
                     cv2.imshow("Calibration", frame)
+            frameId += 1
+            if progress is not None:
+                progress(1)
             if cv2.waitKey(1) == 27:
                 break
         cap3.release()
@@ -0,0 +1,100 @@
+"""
+Face detector backends for GazeTracking.
+
+Every backend is a callable that takes a (grayscale or BGR) frame and returns the detected faces as a list of
+dlib.rectangle, ordered by confidence, so that the dlib landmark predictor can be applied to the faces of every backend.
+
+* dlib_hog: dlib's HOG frontal face detector (the detector of the original OWLET)
+* opencv_dnn: OpenCV's ResNet-10 SSD face detector. Needs deploy.prototxt and res10_300x300_ssd_iter_140000.caffemodel
+  in this directory (see DNN_PROTOTXT_URL and DNN_MODEL_URL)
+* haar: OpenCV's Haar cascade frontal face detector, bundled with opencv-python
+"""
+
+import os
+
+import cv2
+import dlib
+
+MODEL_DIR = os.path.dirname(__file__)
+
+DNN_PROTOTXT_PATH = os.path.join(MODEL_DIR, 'deploy.prototxt')
+DNN_MODEL_PATH = os.path.join(MODEL_DIR, 'res10_300x300_ssd_iter_140000.caffemodel')
+DNN_PROTOTXT_URL = 'https://raw.githubusercontent.com/opencv/opencv/master/samples/dnn/face_detector/deploy.prototxt'
+DNN_MODEL_URL = 'https://raw.githubusercontent.com/opencv/opencv_3rdparty/dnn_samples_face_detector_20170830/' \
+                'res10_300x300_ssd_iter_140000.caffemodel'
+
+HAAR_CASCADE_PATH = os.path.join(cv2.data.haarcascades, 'haarcascade_frontalface_default.xml')
+
+
+def _to_rectangle(left, top, right, bottom, width, height):
+    return dlib.rectangle(int(max(left, 0)), int(max(top, 0)), int(min(right, width - 1)), int(min(bottom, height - 1)))
+
+
+class DlibHogDetector:
+
+    def __init__(self):
+        self.detector = dlib.get_frontal_face_detector()
+
+    def __call__(self, frame):
+        return list(self.detector(frame))
+
+
+class OpenCVDnnDetector:
+
+    def __init__(self, prototxt_path=DNN_PROTOTXT_PATH, model_path=DNN_MODEL_PATH, min_confidence=0.5):
+        for path, url in [(prototxt_path, DNN_PROTOTXT_URL), (model_path, DNN_MODEL_URL)]:
+            if not os.path.isfile(path):
+                exit(f'The opencv_dnn face detector needs {path}, download it from {url}')
+
+        self.net = cv2.dnn.readNetFromCaffe(prototxt_path, model_path)
+        self.min_confidence = min_confidence
+
+    def __call__(self, frame):
+        frame = frame if frame.ndim == 3 else cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+        height, width = frame.shape[:2]
+
+        # the network was trained on 300x300 BGR images with these channel means subtracted
+        self.net.setInput(cv2.dnn.blobFromImage(frame, 1.0, (300, 300), (104.0, 177.0, 123.0)))
+        detections = self.net.forward()[0, 0]
+
+        faces = []
+        for _, _, confidence, left, top, right, bottom in detections:
+            if confidence < self.min_confidence:
+                continue
+            faces.append(_to_rectangle(left * width, top * height, right * width, bottom * height, width, height))
+        return faces
+
+
+class HaarCascadeDetector:
+
+    def __init__(self, cascade_path=HAAR_CASCADE_PATH, scale_factor=1.1, min_neighbors=5):
+        self.classifier = cv2.CascadeClassifier(cascade_path)
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+
+    def __call__(self, frame):
+        frame = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        height, width = frame.shape[:2]
+
+        boxes, _, weights = self.classifier.detectMultiScale3(frame, scaleFactor=self.scale_factor,
+                                                              minNeighbors=self.min_neighbors, outputRejectLevels=True)
+        order = sorted(range(len(boxes)), key=lambda i: -float(weights[i]))
+        return [_to_rectangle(x, y, x + w - 1, y + h - 1, width, height) for x, y, w, h in (boxes[i] for i in order)]
+
+
+DETECTORS = {
+    'dlib_hog': DlibHogDetector,
+    'opencv_dnn': OpenCVDnnDetector,
+    'haar': HaarCascadeDetector,
+}
+
+
+def create_face_detector(name):
+    if name not in DETECTORS:
+        exit(f'Unknown face detector {name}, choose one of {", ".join(DETECTORS.keys())}')
+    return DETECTORS[name]()
+
+
+def select_face(faces):
+    """Returns the index of the face to track: if there are two faces detected, take the lower one (the infant)"""
+    return 1 if len(faces) > 1 and (faces[1].bottom() > faces[0].bottom()) else 0
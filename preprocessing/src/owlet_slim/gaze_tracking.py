@@ -17,10 +17,10 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from __future__ import division
-import os
 import cv2
-import dlib
 
+from . import models
+from .face_detectors import select_face
 from .eye import Eye
 
 
@@ -31,14 +31,14 @@ class GazeTracking(object):
     and pupils and allows to know if the eyes are open or closed
     """
 
-    def __init__(self, mean, maximum, minimum, ratio, length):
+    def __init__(self, mean, maximum, minimum, ratio, length, face_detector='dlib_hog'):
         self.frame = None
         self.eye_left = None
         self.eye_right = None
         self.face_index = 0
         self.face = None
-        # _face_detector is used to detect faces
-        self._face_detector = dlib.get_frontal_face_detector()
+        # _face_detector is used to detect faces, shared by all instances in the process
+        self._face_detector = models.get_face_detector(face_detector)
         self.eye_scale = mean
         self.blink_thresh = maximum * 1.1
         self.blink_thresh2 = minimum * .9
@@ -47,9 +47,8 @@ class GazeTracking(object):
         self.leftright_eyeratio = ratio
         self.length = length
 
-        # _predictor is used to get facial landmarks of a given face
-        model_path = os.path.join(os.path.dirname(__file__), "shape_predictor_68_face_landmarks.dat")
-        self._predictor = dlib.shape_predictor(model_path)
+        # _predictor is used to get facial landmarks of a given face, shared by all instances in the process
+        self._predictor = models.get_shape_predictor()
         # eyepath = os.path.join(os.path.dirname(__file__), "=haarcascade_eye.xml")) # Missing from repository
         # self.eye_classifier = cv2.CascadeClassifier(eyepath)
 
@@ -68,12 +67,12 @@ class GazeTracking(object):
     def _analyze(self):
         """Detects the face and initialize Eye objects"""
      
-        frame = cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY)
+        # decoders can deliver grayscale frames directly
+        frame = self.frame if self.frame.ndim == 2 else cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY)
         
         faces = self._face_detector(frame)
             
-        # if there are two faces detected, take the lower face
-        self.face_index = 1 if len(faces) > 1 and (faces[1].bottom() > faces[0].bottom()) else 0
+        self.face_index = select_face(faces)
         
         try:
             landmarks = self._predictor(frame, faces[self.face_index])
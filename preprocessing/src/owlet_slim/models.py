@@ -0,0 +1,35 @@
+"""
+Process-wide registry for the face detector and dlib landmark models used by GazeTracking.
+
+Loading the 68-point shape predictor reads a ~100 MB model file, so every model is only loaded once per process
+and all GazeTracking instances (per video, per calibration) share the same objects. Every job queue worker is its
+own process and loads the models once, on its first OWLET job.
+"""
+
+import os
+import threading
+
+import dlib
+
+from .face_detectors import create_face_detector
+
+SHAPE_PREDICTOR_PATH = os.path.join(os.path.dirname(__file__), "shape_predictor_68_face_landmarks.dat")
+
+_models = dict()
+_lock = threading.Lock()
+
+
+def _get(key, load):
+    with _lock:
+        if key not in _models:
+            _models[key] = load()
+        return _models[key]
+
+
+def get_face_detector(name='dlib_hog'):
+    """Returns the face detector backend with the given name, see face_detectors.DETECTORS"""
+    return _get(('face_detector', name), lambda: create_face_detector(name))
+
+
+def get_shape_predictor(model_path=SHAPE_PREDICTOR_PATH):
+    return _get(('shape_predictor', model_path), lambda: dlib.shape_predictor(model_path))
@@ -0,0 +1,44 @@
+"""
+Incremental csv output of the per-frame gaze estimates.
+"""
+
+import os
+import csv
+
+
+class GazeCsvWriter:
+    """
+    Streams rows to {path}.part while frames are processed and moves the file to path once the video is done,
+    so that a partial output is never mistaken for a finished one. Rows are written in frame order, which is why
+    no sorting is needed afterwards.
+    """
+
+    def __init__(self, path, columns, resume_offset=None):
+        self.path = path
+        self.part_path = f'{path}.part'
+        self.columns = columns
+
+        if resume_offset is not None and os.path.isfile(self.part_path):
+            # drop everything that was written after the checkpoint the run resumes from
+            self.file = open(self.part_path, 'r+', newline='', encoding='utf-8')
+            self.file.truncate(resume_offset)
+            self.file.seek(resume_offset)
+            self.writer = csv.writer(self.file)
+        else:
+            self.file = open(self.part_path, 'w', newline='', encoding='utf-8')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(columns)
+
+    def write(self, row):
+        """Writes a row given as dict with (at least) the configured columns"""
+        self.writer.writerow([row[c] for c in self.columns])
+
+    def offset(self):
+        """Flushes the rows written so far and returns the file position, to be stored in a checkpoint"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+        os.replace(self.part_path, self.path)
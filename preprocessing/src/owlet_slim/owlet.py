@@ -17,20 +17,42 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import os
+import pickle
 
 import cv2
-import pandas as pd
 
 from .gaze_tracking import GazeTracking
 from .calibration_og import LookingCalibration
+from .video import open_video
+from .output import GazeCsvWriter
 #from .calibration import LookingCalibration
 
 class OWLET(object):
 
-    def __init__(self, presentation_width, presentation_height):
+    # attributes that are rebuilt when processing starts and therefore not part of a checkpoint
+    TRANSIENT_ATTRIBUTES = ['gaze', 'frame']
+    # settings of the current run, which a resumed checkpoint must not overwrite
+    CONFIGURATION_ATTRIBUTES = ['presentation_width', 'presentation_height', 'decoder', 'face_detector',
+                                'checkpoint_interval']
+    # attributes set by calibrate_gaze, saved by save_calibration so that other processes can reuse a calibration
+    CALIBRATION_ATTRIBUTES = ['calibration_failure', 'min_xval', 'max_xval', 'range_xvals', 'middle_x', 'min_xval2',
+                              'max_xval2', 'range_xvals2', 'middle_x2', 'min_yval', 'max_yval', 'range_yvals',
+                              'middle_y', 'range_yvals_left', 'range_yvals_right', 'min_yval_left', 'min_yval_right',
+                              'mean', 'maximum', 'minimum', 'eyearea', 'mean_eyeratio', 'maxeyeratio', 'mineyeratio',
+                              'length']
+
+    def __init__(self, presentation_width, presentation_height, decoder='cv2', checkpoint_interval=None,
+                 face_detector='dlib_hog'):
 
         self.presentation_width = presentation_width
         self.presentation_height = presentation_height
+        # 'cv2' or 'ffmpeg', see video.open_video. The ffmpeg decoder delivers grayscale frames, as that is all
+        # the gaze tracking needs.
+        self.decoder = decoder
+        # name of the face detector backend, see face_detectors.DETECTORS
+        self.face_detector = face_detector
+        # number of frames after which the progress of process_video is saved, None disables checkpointing
+        self.checkpoint_interval = checkpoint_interval
         self.calibration_failure = False
 
         self.initialize_cur_gaze_list()
@@ -56,11 +78,22 @@ class OWLET(object):
         self.initialize_cur_gaze_list()
         self.initialize_potential_gaze_list()
 
-    def process_video(self, input_video, output_csv):
-        video = cv2.VideoCapture(input_video, )
-        fps = video.get(cv2.CAP_PROP_FPS)
+    def process_video(self, input_video, output_csv, crop=None, progress=None):
+        """
+        Estimates the gaze for every frame of a video and streams the results to a csv file.
+        If checkpointing is enabled, the position in the output and the tracker state are saved periodically to
+        {output_csv}.checkpoint, and an interrupted run of the same video resumes from there.
+
+        Arguments:
+            input_video (str): The path of the subject video
+            output_csv (str): The path of the resulting csv file
+            crop (tuple): Optional (width, height) aspect ratio the frames get cropped to before the analysis
+            progress (callable): Optionally called with the number of newly processed frames, e.g. for telemetry
+        """
+        video = open_video(input_video, self.decoder, crop=crop, gray=self.decoder == 'ffmpeg')
+        fps = video.fps
+        checkpoint_path = f'{output_csv}.checkpoint'
 
-        df_dict_list = []
         df_dict = dict()
 
         df_dict['calibration_failure'] = self.calibration_failure
@@ -69,13 +102,20 @@ class OWLET(object):
 
         self.initialize_eye_tracker()
 
-        success, frame = video.read()
-        count = 0
+        output_columns = list(df_dict.keys()) + ['t', 'x', 'y']
+        count, output_offset = 0, None
+        if self.checkpoint_interval and os.path.isfile(f'{output_csv}.part'):
+            count, output_offset = self.load_checkpoint(checkpoint_path, input_video)
+        if count > 0:
+            print(f'Resuming {input_video} at frame {count}')
+            video.skip(count)
+
+        output = GazeCsvWriter(output_csv, output_columns, resume_offset=output_offset)
+
+        success, frame = video.read()  # already cropped and resized to 960x540
         while success:
             t = count * 1000 / fps
 
-            frame = cv2.resize(frame, (960, 540))  # test change ###############
-
             frame = self.determine_gaze(frame)
             # cv2.imshow("test", frame)
             # key = cv2.waitKey(100)
@@ -86,21 +126,84 @@ class OWLET(object):
             df_dict['x'] = xcoord
             df_dict['y'] = ycoord
 
-            df_dict_list.append(dict(df_dict))
+            output.write(df_dict)
 
             #print(t, xcoord, ycoord)
 
             success, frame = video.read()
             count += 1
+            if progress is not None:
+                progress(1)
+
+            if self.checkpoint_interval and count % self.checkpoint_interval == 0:
+                self.save_checkpoint(checkpoint_path, input_video, count, output.offset())
 
         video.release()
-        res = pd.DataFrame(df_dict_list) \
-            .sort_values(['t']) \
-            .reset_index(drop=True)
+        output.close()
+
+        if os.path.isfile(checkpoint_path):
+            os.remove(checkpoint_path)
+
+    @staticmethod
+    def _video_signature(input_video):
+        stat = os.stat(input_video)
+        return {'path': os.path.abspath(input_video), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    @classmethod
+    def _tracker_state(cls, attributes):
+        excluded = cls.TRANSIENT_ATTRIBUTES + cls.CONFIGURATION_ATTRIBUTES
+        return {k: v for k, v in attributes.items() if k not in excluded}
+
+    def save_checkpoint(self, checkpoint_path, input_video, frame_count, output_offset):
+        """
+        Saves the progress in the output file together with the complete tracker state (calibration values, gaze lists,
+        prior gaze positions and the pupil positions the GazeTracking object carries over between frames)
 
-        res.to_csv(output_csv, encoding='utf-8', index=False)
+        Arguments:
+            checkpoint_path (str): The path of the checkpoint file
+            input_video (str): The path of the video that is being processed
+            frame_count (int): The number of frames processed so far
+            output_offset (int): The position in the partial output file after the rows of the processed frames
+        """
+        checkpoint = {
+            'video': self._video_signature(input_video),
+            'frame_count': frame_count,
+            'output_offset': output_offset,
+            'tracker_state': self._tracker_state(self.__dict__),
+            'gaze_state': {'leftpoint': self.gaze.leftpoint, 'rightpoint': self.gaze.rightpoint},
+        }
+
+        # write to a temporary file first so that a crash while saving does not destroy the last checkpoint
+        with open(f'{checkpoint_path}.tmp', 'wb') as f:
+            pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f'{checkpoint_path}.tmp', checkpoint_path)
+
+    def load_checkpoint(self, checkpoint_path, input_video):
+        """
+        Restores the tracker state from a checkpoint of the same video. Needs to be called after
+        initialize_eye_tracker.
 
-    def calibrate_gaze(self, calib_file, show_output):
+        Returns:
+            the number of frames already processed and the position in the partial output file to continue at
+            (0 and None without a checkpoint)
+        """
+        if not os.path.isfile(checkpoint_path):
+            return 0, None
+
+        with open(checkpoint_path, 'rb') as f:
+            checkpoint = pickle.load(f)
+
+        if checkpoint['video'] != self._video_signature(input_video):
+            print(f'Ignoring checkpoint {checkpoint_path}, as the video changed')
+            return 0, None
+
+        self.__dict__.update(self._tracker_state(checkpoint['tracker_state']))
+        self.gaze.leftpoint = checkpoint['gaze_state']['leftpoint']
+        self.gaze.rightpoint = checkpoint['gaze_state']['rightpoint']
+
+        return checkpoint['frame_count'], checkpoint['output_offset']
+
+    def calibrate_gaze(self, calib_file, show_output, crop=None, analysis_fps=None, progress=None):
         """
         Initializes a calibration object and calibrates the extreme scaled
         and unscaled xy gaze positions, the mean/max/min eye blinking ratios,
@@ -108,14 +211,18 @@ class OWLET(object):
 
         Arguments:
             calib_file (str): The path of the calibration video
+            crop (tuple): Optional (width, height) aspect ratio the frames get cropped to before the analysis
+            analysis_fps (float): Optional rate at which frames are analysed, None analyses every frame
+            progress (callable): Optionally called with the number of newly passed frames (analysed or skipped)
         """
 
         # This try-catch block is a temporary hack - the original implementation crashes for certain calibration video
         # properties. Use an additional variable to mark participants whether the calibration was successful
         try:
 
-            calib = LookingCalibration(show_output, os.getcwd())
-            calib.calibrate_eyes(calib_file, 0)
+            calib = LookingCalibration(show_output, os.getcwd(), self.face_detector)
+            calib.calibrate_eyes(calib_file, 0, crop=crop, decoder=self.decoder, analysis_fps=analysis_fps,
+                                 progress=progress)
             self.min_xval, self.max_xval, self.range_xvals, self.middle_x = calib.get_min_max_hor()
             self.min_yval, self.max_yval, self.range_yvals, self.middle_y, self.range_yvals_left, \
             self.range_yvals_right, self.min_yval_left, self.min_yval_right = calib.get_min_max_ver()
@@ -127,8 +234,8 @@ class OWLET(object):
             self.length = calib.get_avg_length()
 
             ## This code was targetting the refactored version of the calibration - exchange with code above in case I come around to fixing the calibration
-            #calib = LookingCalibration(show_output)
-            #calib.calibrate_eyes(calib_file)
+            #calib = LookingCalibration(show_output, self.face_detector)
+            #calib.calibrate_eyes(calib_file, crop=crop, decoder=self.decoder)
             #self.min_xval, self.max_xval, self.range_xvals, self.middle_x = calib.get_min_max_hor(1)
             #self.min_yval, self.max_yval, self.range_yvals, self.middle_y, self.range_yvals_left, \
             #    self.range_yvals_right, self.min_yval_left, self.min_yval_right = calib.get_min_max_ver()
@@ -152,6 +259,18 @@ class OWLET(object):
             self.mean_eyeratio, self.maxeyeratio, self.mineyeratio = 1.0, 1.35, .65
             self.eyearea = -999
 
+    def save_calibration(self, calibration_path):
+        """Saves the values determined by calibrate_gaze (including a calibration failure)"""
+        calibration = {k: getattr(self, k) for k in self.CALIBRATION_ATTRIBUTES}
+        with open(f'{calibration_path}.tmp', 'wb') as f:
+            pickle.dump(calibration, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f'{calibration_path}.tmp', calibration_path)
+
+    def load_calibration(self, calibration_path):
+        """Restores the values of a calibration saved with save_calibration instead of calibrating again"""
+        with open(calibration_path, 'rb') as f:
+            self.__dict__.update(pickle.load(f))
+
     def initialize_cur_gaze_list(self):
         """Initializes lists for the current gaze positions"""
         self.cur_fix_hor = []
@@ -227,7 +346,8 @@ class OWLET(object):
         self.haslooked = False
         # -----
 
-        self.gaze = GazeTracking(self.mean, self.maximum, self.minimum, self.mean_eyeratio, self.length)
+        self.gaze = GazeTracking(self.mean, self.maximum, self.minimum, self.mean_eyeratio, self.length,
+                                 self.face_detector)
         self.threshold = self.range_xvals/6
         if self.range_xvals < .1:
             self.threshold = .1/6
@@ -0,0 +1,214 @@
+"""
+Helpers for decoding the webcam videos analyzed by OWLET.
+"""
+
+import json
+import subprocess
+
+import cv2
+import numpy as np
+
+# frame size (width, height) that all OWLET analyses run on
+ANALYSIS_SIZE = (960, 540)
+
+
+def crop_height(width, height, aspect_ratio):
+    """
+    Returns the (start, end) rows of a vertically centred crop to the given (width, height) aspect ratio,
+    matching ffmpeg's crop=iw:iw*h/w filter. Frames that are already wider than the aspect ratio stay uncropped.
+    """
+    cropped_height = min(height, int(width * aspect_ratio[1] / aspect_ratio[0]))
+    start = (height - cropped_height) // 2
+    return start, start + cropped_height
+
+
+def crop_frame(frame, aspect_ratio):
+    """Crops a decoded frame to the aspect ratio by slicing, without copying the pixel data"""
+    if aspect_ratio is None:
+        return frame
+
+    start, end = crop_height(frame.shape[1], frame.shape[0], aspect_ratio)
+    return frame[start:end]
+
+
+def probe_video(path):
+    """Returns width, height and frame rate of the first video stream of a file, read from the container metadata"""
+    result = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                             '-show_entries', 'stream=width,height,avg_frame_rate,r_frame_rate', '-of', 'json', path],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    stream = json.loads(result.stdout)['streams'][0]
+
+    frame_rate = stream['avg_frame_rate'] if stream['avg_frame_rate'] != '0/0' else stream['r_frame_rate']
+    numerator, denominator = frame_rate.split('/')
+    return int(stream['width']), int(stream['height']), float(numerator) / float(denominator)
+
+
+def probe_frame_count(path):
+    """
+    Returns the number of frames of the first video stream of a file, from the container metadata if it has it
+    (mp4), otherwise by counting the packets of the stream (webm), which demuxes but does not decode the file
+    """
+    result = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                             '-show_entries', 'stream=nb_frames', '-of', 'json', path],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    stream = json.loads(result.stdout)['streams'][0]
+    if stream.get('nb_frames', 'N/A') != 'N/A':
+        return int(stream['nb_frames'])
+
+    result = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-count_packets',
+                             '-show_entries', 'stream=nb_read_packets', '-of', 'json', path],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    return int(json.loads(result.stdout)['streams'][0]['nb_read_packets'])
+
+
+class CV2FrameReader:
+    """Decodes frames with cv2.VideoCapture and crops and resizes them to the analysis size in Python"""
+
+    def __init__(self, path, size=ANALYSIS_SIZE, crop=None, gray=False, analysis_fps=None):
+        self.video = cv2.VideoCapture(path, )
+        self.fps = self.video.get(cv2.CAP_PROP_FPS)
+        # only every frame_step-th frame gets read, the frames in between are only grabbed
+        self.frame_step = frame_step(self.fps, analysis_fps)
+        self.size = size
+        self.crop = crop
+        self.gray = gray
+        self.frame = np.empty((size[1], size[0], 3), dtype=np.uint8)
+
+    def is_opened(self):
+        return self.video.isOpened()
+
+    def grab(self):
+        """Advances to the next frame without decoding it into an image"""
+        return self.video.grab()
+
+    def read(self):
+        """Returns (success, frame). The frame buffer gets reused by the next call."""
+        success, frame = self.video.read()
+        if not success:
+            return False, None
+
+        cv2.resize(crop_frame(frame, self.crop), self.size, dst=self.frame)
+        return True, cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY) if self.gray else self.frame
+
+    def position_msec(self):
+        return self.video.get(cv2.CAP_PROP_POS_MSEC)
+
+    def frame_count(self):
+        """Number of frames of the video, as reported by the container"""
+        return int(self.video.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    def skip(self, n):
+        """Skips n frames, returns whether all of them were present"""
+        return all(self.grab() for _ in range(n))
+
+    def release(self):
+        self.video.release()
+
+
+class FFmpegFrameReader:
+    """
+    Lets ffmpeg crop, scale and convert the frames to the analysis size and pixel format (bgr24 or gray) and reads
+    the raw frames from a pipe straight into a preallocated buffer, so that no per-frame resizing, colour conversion
+    or allocation happens in Python.
+    With analysis_fps, ffmpeg drops all but every frame_step-th frame before cropping and scaling, so the frames in
+    between never reach the pipe and grab() only counts them.
+    """
+
+    def __init__(self, path, size=ANALYSIS_SIZE, crop=None, gray=False, analysis_fps=None):
+        self.path = path
+        width, height, self.fps = probe_video(path)
+        self.frame_step = frame_step(self.fps, analysis_fps)
+
+        filters = []
+        if self.frame_step > 1:
+            filters.append(f'select=not(mod(n\\,{self.frame_step}))')
+        if crop is not None:
+            start, end = crop_height(width, height, crop)
+            filters.append(f'crop={width}:{end - start}:0:{start}')
+        # bilinear to match cv2.resize
+        filters.append(f'scale={size[0]}:{size[1]}:flags=bilinear')
+
+        self.frame = np.empty((size[1], size[0]) if gray else (size[1], size[0], 3), dtype=np.uint8)
+        self.buffer = memoryview(self.frame).cast('B')
+        self.frame_index = 0
+
+        self.process = subprocess.Popen(['ffmpeg', '-v', 'error',
+                                         '-i', path,
+                                         '-vf', ','.join(filters),
+                                         '-vsync', 'passthrough',
+                                         '-f', 'rawvideo',
+                                         '-pix_fmt', 'gray' if gray else 'bgr24',
+                                         'pipe:'],
+                                        stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
+
+    def is_opened(self):
+        return self.process is not None
+
+    def grab(self):
+        """
+        Reads the next frame from the pipe into the buffer. Frames that ffmpeg dropped are only counted, so grabbing
+        one of them succeeds even past the end of the video; the next frame that gets read reports the end.
+        """
+        if self.frame_index % self.frame_step != 0:
+            self.frame_index += 1
+            return True
+
+        read = 0
+        while read < len(self.buffer):
+            n = self.process.stdout.readinto(self.buffer[read:])
+            if not n:
+                return False
+            read += n
+
+        self.frame_index += 1
+        return True
+
+    def read(self):
+        """Returns (success, frame). The frame buffer gets reused by the next call."""
+        if not self.grab():
+            return False, None
+        return True, self.frame
+
+    def position_msec(self):
+        # timestamp of the last frame that was read
+        return max(self.frame_index - 1, 0) * 1000 / self.fps
+
+    def frame_count(self):
+        """Number of frames of the video (including the ones dropped by frame_step), see probe_frame_count"""
+        return probe_frame_count(self.path)
+
+    def skip(self, n):
+        """Skips n frames, returns whether all of them were present"""
+        return all(self.grab() for _ in range(n))
+
+    def release(self):
+        if self.process is None:
+            return
+        self.process.stdout.close()
+        self.process.terminate()
+        self.process.wait()
+        self.process = None
+
+
+def frame_step(fps, analysis_fps):
+    """Returns n so that analysing every n-th frame comes closest to analysis_fps (1 for None)"""
+    return 1 if analysis_fps is None else max(1, round(fps / analysis_fps))
+
+
+def open_video(path, decoder='cv2', crop=None, gray=False, analysis_fps=None):
+    """
+    Opens a video for frame-by-frame analysis at ANALYSIS_SIZE
+
+    Arguments:
+        path (str): The path of the video
+        decoder (str): 'cv2' to decode with OpenCV, 'ffmpeg' to let an ffmpeg process deliver raw frames
+        crop (tuple): Optional (width, height) aspect ratio the frames get cropped to before scaling
+        gray (bool): Whether to return single channel grayscale frames instead of BGR frames
+        analysis_fps (float): Optional rate at which frames get read, every reader.frame_step-th frame is read and the
+            ones in between must only be grabbed. None reads every frame.
+    """
+    if decoder == 'cv2':
+        return CV2FrameReader(path, crop=crop, gray=gray, analysis_fps=analysis_fps)
+    if decoder == 'ffmpeg':
+        return FFmpegFrameReader(path, crop=crop, gray=gray, analysis_fps=analysis_fps)
+    raise ValueError(f'Unknown decoder {decoder}')
@@ -0,0 +1,136 @@
+import os
+import json
+
+import settings
+from .cache import file_fingerprint
+
+
+class ParticipantDataIndex:
+    """
+    Sidecar index of a participant's {p}_data.json, built during a single parse of the file.
+    It records the window size, the byte ranges of all video and webgazer-validate trials and their sample counts,
+    so that consumers can read the window size without parsing anything and decode only the trials they need.
+    """
+
+    INDEX_VERSION = 1
+
+    def __init__(self, participant):
+        self.participant = participant
+        self.data_file = f'{settings.DATA_DIR}/{participant}_data.json'
+        self.index_file = os.path.join(settings.CACHE_DIR, 'index', f'{participant}_data.json')
+        self._parsed = None
+
+        self.index = self._load() if os.path.isfile(self.data_file) else None
+
+    @property
+    def exists(self):
+        return self.index is not None
+
+    @property
+    def window_width(self):
+        return self.index['window_width']
+
+    @property
+    def window_height(self):
+        return self.index['window_height']
+
+    def video_trials(self):
+        return self._read(self.index['video_trials'])
+
+    def validation_trials(self):
+        return self._read(self.index['validation_trials'])
+
+    def _load(self):
+        if os.path.isfile(self.index_file):
+            with open(self.index_file) as f:
+                index = json.load(f)
+
+            if index['version'] == self.INDEX_VERSION:
+                fingerprint = file_fingerprint(self.data_file, index['source'])
+                if fingerprint['sha1'] == index['source']['sha1']:
+                    return index
+
+        return self._build()
+
+    def _build(self):
+        with open(self.data_file, 'rb') as f:
+            raw = f.read()
+        text = raw.decode('utf-8')
+
+        index = {'version': self.INDEX_VERSION,
+                 'source': file_fingerprint(self.data_file),
+                 'window_width': None,
+                 'window_height': None,
+                 'video_trials': [],
+                 'validation_trials': []}
+        self._parsed = {}
+
+        for trial, start, end in self._scan_array(text, len(raw) == len(text)):
+            if 'task' in trial and trial['task'] == 'video':
+                # we have to assume that the window size did not change over the course of the experiment
+                if index['window_width'] is None:
+                    index['window_width'] = trial['windowWidth']
+                    index['window_height'] = trial['windowHeight']
+
+                index['video_trials'].append({'start': start, 'end': end,
+                                              'stimulus': trial['stimulus'][0].split("/")[-1].split(".")[0],
+                                              'samples': len(trial['webgazer_data'])})
+                self._parsed[start] = trial
+
+            elif 'trial_type' in trial and trial['trial_type'] == 'webgazer-validate':
+                index['validation_trials'].append({'start': start, 'end': end,
+                                                   'samples': sum(len(p) for p in trial.get('raw_gaze', []))})
+                self._parsed[start] = trial
+
+        if not os.path.exists(os.path.dirname(self.index_file)):
+            os.makedirs(os.path.dirname(self.index_file), exist_ok=True)  # may be created concurrently by a worker
+
+        with open(f'{self.index_file}.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(f'{self.index_file}.tmp', self.index_file)
+
+        return index
+
+    def _read(self, entries):
+        # trials that were decoded while building the index in this process do not need to be read again
+        if self._parsed is not None:
+            return [self._parsed[entry['start']] for entry in entries]
+
+        trials = []
+        with open(self.data_file, 'rb') as f:
+            for entry in entries:
+                f.seek(entry['start'])
+                trials.append(json.loads(f.read(entry['end'] - entry['start'])))
+        return trials
+
+    @staticmethod
+    def _scan_array(text, is_ascii):
+        """Yields every element of the top level json array together with its byte range in the file"""
+        decoder = json.JSONDecoder()
+        whitespace = ' \t\n\r'
+
+        pos = 0
+        while text[pos] in whitespace:
+            pos += 1
+        if text[pos] != '[':
+            raise ValueError('Expected the participant data to be a json array')
+        pos += 1
+
+        byte_pos, char_pos = pos, pos
+        while True:
+            while text[pos] in whitespace or text[pos] == ',':
+                pos += 1
+            if text[pos] == ']':
+                return
+
+            element, end = decoder.raw_decode(text, pos)
+
+            if is_ascii:
+                start_byte, end_byte = pos, end
+            else:
+                start_byte = byte_pos + len(text[char_pos:pos].encode('utf-8'))
+                end_byte = start_byte + len(text[pos:end].encode('utf-8'))
+                byte_pos, char_pos = end_byte, end
+
+            yield element, start_byte, end_byte
+            pos = end
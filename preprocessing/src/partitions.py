@@ -0,0 +1,67 @@
+import os
+import pickle
+import shutil
+
+import settings
+
+
+class PartitionStore:
+    """
+    On-disk store of a tracker's data with one partition per trial (id x stimulus), used by the handlers in out-of-core
+    mode. Every partition is a pickled DataFrame, so only one trial needs to be in memory at a time.
+    """
+
+    def __init__(self, name, kind):
+        self.dir = os.path.join(settings.PARTITION_DIR, name, kind)
+        self.partitions = dict()  # (id, stimulus) -> trial position, used for ordering
+
+    def clear(self):
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.makedirs(self.dir)
+        self.partitions = dict()
+
+    def _path(self, participant, stimulus):
+        return os.path.join(self.dir, participant, f'{stimulus}.pkl')
+
+    def put(self, participant, stimulus, data):
+        path = self._path(participant, stimulus)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        with open(path, 'wb') as f:
+            pickle.dump(data.reset_index(drop=True), f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.partitions[(participant, stimulus)] = data['trial'].min() if 'trial' in data.columns else None
+
+    def write(self, data):
+        """Splits a frame (e.g. all data of a participant) into its trials and stores them"""
+        for (participant, stimulus), trial in data.groupby(['id', 'stimulus'], sort=False, observed=True):
+            self.put(participant, stimulus, trial)
+
+    def get(self, participant, stimulus):
+        with open(self._path(participant, stimulus), 'rb') as f:
+            return pickle.load(f)
+
+    def remove(self, participant, stimulus):
+        os.remove(self._path(participant, stimulus))
+        del self.partitions[(participant, stimulus)]
+
+    def keys(self, by_trial=False):
+        """(id, stimulus) of all partitions, sorted by id and stimulus or, with by_trial, by id and trial position"""
+        if by_trial:
+            return sorted(self.partitions.keys(), key=lambda key: (key[0], self.partitions[key], key[1]))
+        return sorted(self.partitions.keys())
+
+    def frames(self, by_trial=False):
+        for participant, stimulus in self.keys(by_trial):
+            yield self.get(participant, stimulus)
+
+    def to_csv(self, path, by_trial=False):
+        """Writes all partitions to a single csv file, one partition at a time"""
+        columns = None
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            for data in self.frames(by_trial):
+                header = columns is None
+                if header:
+                    columns = list(data.columns)
+                data.reindex(columns=columns).to_csv(f, header=header, index=False)
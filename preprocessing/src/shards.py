@@ -0,0 +1,212 @@
+"""
+Deterministic sharding of the participants across machines (main.py --shard i/N) and the merge of the per-shard
+results into the layout of a single run (main.py --merge).
+
+Shards share the intermediate files (webcam videos, tracker results, caches), which are stored per participant anyway.
+Everything that covers multiple participants (data tables, window sizes, exclusion files) is written to
+shards/{i}_of_{N} subdirectories of OUT_DIR and EXCLUSION_DIR instead.
+"""
+
+import os
+import glob
+import heapq
+import hashlib
+
+import pandas as pd
+
+import settings
+
+SHARD_DIR_NAME = 'shards'
+
+
+def parse_shard(value):
+    """Parses 'i/N' (1 <= i <= N) into (i, N)"""
+    try:
+        index, count = [int(v) for v in value.split('/')]
+    except ValueError:
+        exit(f'Invalid shard {value}, expected the format i/N, e.g. 1/4')
+
+    if count < 1 or index < 1 or index > count:
+        exit(f'Invalid shard {value}, i has to be between 1 and N')
+    return index, count
+
+
+def shard_of(participant, count):
+    """Stable shard number (1 to count) of a participant, independent of the python hash seed and the machine"""
+    return int(hashlib.sha1(participant.encode('utf-8')).hexdigest(), 16) % count + 1
+
+
+def shard_participants(participants, shard):
+    index, count = shard
+    return set(p for p in participants if shard_of(p, count) == index)
+
+
+def apply_shard(shard):
+    """Redirects the outputs that cover multiple participants to the directories of the shard"""
+    index, count = shard
+    name = f'{index}_of_{count}'
+
+    settings.SHARD = shard
+    settings.RESULTS_DIR = os.path.join(settings.OUT_DIR, SHARD_DIR_NAME, name)
+    settings.RESULTS_EXCLUSION_DIR = os.path.join(settings.EXCLUSION_DIR, SHARD_DIR_NAME, name)
+    settings.PARTITION_DIR = os.path.join(settings.RESULTS_DIR, 'partitions')
+
+    # these need the data of all participants and are created by the merge instead
+    settings.SAVE_GAZE_CUBE = False
+    settings.COMPUTE_TIME_COURSES = False
+
+    for directory in [settings.RESULTS_DIR, settings.RESULTS_EXCLUSION_DIR]:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+
+def exclusion_file(filename):
+    """
+    Path an exclusion file is read from: the merged file in EXCLUSION_DIR if it exists, the file of the current shard
+    otherwise (for runs without --shard, both are the same)
+    """
+    merged = os.path.join(settings.EXCLUSION_DIR, filename)
+    return merged if os.path.isfile(merged) else os.path.join(settings.RESULTS_EXCLUSION_DIR, filename)
+
+
+def shard_names(base_dir):
+    """Names of the shard directories in base_dir, checking that they come from a single, complete set of shards"""
+    names = [os.path.basename(path) for path in glob.glob(os.path.join(base_dir, SHARD_DIR_NAME, '*_of_*'))]
+    shards = sorted(parse_shard(name.replace('_of_', '/')) for name in names)
+    if len(shards) == 0:
+        return []
+
+    counts = set(count for _, count in shards)
+    if len(counts) > 1:
+        exit(f'Found shards of different runs ({", ".join(f"N={c}" for c in sorted(counts))}) in '
+             f'{os.path.join(base_dir, SHARD_DIR_NAME)}, please remove the outdated ones')
+
+    count = counts.pop()
+    missing = [i for i in range(1, count + 1) if (i, count) not in shards]
+    if len(missing) > 0:
+        exit(f'Shards {", ".join(f"{i}/{count}" for i in missing)} are missing in {os.path.join(base_dir, SHARD_DIR_NAME)}')
+
+    return [f'{index}_of_{count}' for index, count in shards]
+
+
+def shard_files(base_dir, filename):
+    """
+    Paths of a file in all shards. A merge of only some of them would silently lack the participants of the others,
+    so either every shard has to have written the file or none of them (e.g. a tracker that did not run at all).
+    """
+    names = shard_names(base_dir)
+    paths = [os.path.join(base_dir, SHARD_DIR_NAME, name, filename) for name in names]
+    missing = [name.replace('_of_', '/') for name, path in zip(names, paths) if not os.path.isfile(path)]
+    if len(missing) == len(paths):
+        return []
+    if len(missing) > 0:
+        exit(f'{filename} is missing in shards {", ".join(missing)} of {os.path.join(base_dir, SHARD_DIR_NAME)}, '
+             f'run the same steps on all shards before merging')
+    return paths
+
+
+def merge_csv(paths, output_path, order=None):
+    """
+    Concatenates the csv files of the shards. Values are kept as they were written (no parsing), rows are stably sorted
+    by id so that they end up in the same order as in a single run, or by a custom order function.
+    """
+    tables = []
+    for path in paths:
+        try:
+            tables.append(pd.read_csv(path, dtype=str, keep_default_na=False))
+        except pd.errors.EmptyDataError:  # e.g. no window sizes in a shard
+            continue
+    if len(tables) == 0:
+        return None
+
+    merged = pd.concat(tables)
+    merged = order(merged) if order else merged.sort_values('id', kind='stable')
+    merged.to_csv(output_path, encoding='utf-8', index=False)
+    return merged
+
+
+def _participant_blocks(path):
+    """Yields (id, rows) of a csv file sorted by id, reading it in chunks of MERGE_CHUNK_ROWS rows"""
+    try:
+        reader = pd.read_csv(path, dtype=str, keep_default_na=False, chunksize=settings.MERGE_CHUNK_ROWS)
+    except pd.errors.EmptyDataError:
+        return
+
+    previous = None
+    carry = None
+    for chunk in reader:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk])
+        if len(chunk.index) == 0:
+            continue
+
+        # the rows of the last participant might continue in the next chunk
+        last = chunk['id'].iloc[-1]
+        carry = chunk[chunk['id'] == last]
+        for participant, rows in chunk[chunk['id'] != last].groupby('id', sort=False):
+            if previous is not None and participant <= previous:
+                exit(f'{path} is not sorted by id, it cannot be merged')
+            previous = participant
+            yield participant, rows
+
+    if carry is not None and len(carry.index) > 0:
+        if previous is not None and carry['id'].iloc[0] <= previous:
+            exit(f'{path} is not sorted by id, it cannot be merged')
+        yield carry['id'].iloc[0], carry
+
+
+def merge_sorted_csv(paths, output_path):
+    """
+    Like merge_csv without a custom order, but for large files sorted by id (the data tables): as every participant
+    is in a single shard, the files are merged participant by participant without reading them into memory
+    """
+    columns = []
+    for path in paths:
+        try:
+            columns += [c for c in pd.read_csv(path, nrows=0).columns if c not in columns]
+        except pd.errors.EmptyDataError:
+            continue
+    if len(columns) == 0:
+        return None
+
+    with open(output_path, 'w', encoding='utf-8', newline='') as f:
+        header = True
+        for _, rows in heapq.merge(*[_participant_blocks(path) for path in paths], key=lambda block: block[0]):
+            rows.reindex(columns=columns).to_csv(f, header=header, index=False)
+            header = False
+        if header:
+            f.write(','.join(columns) + '\n')
+    return output_path
+
+
+def sort_exclusions(exclusions, reasons=None):
+    """
+    Sorts exclusion rows like utils.create_empty_general_exclusion_df does. If reasons are given, rows with these
+    exclusion reasons come first, in that order (like _automatically_exclude_specific does it).
+    """
+    stimulus_order = {s: i for i, s in enumerate(settings.stimuli)}
+    rank = exclusions['exclusion_reason'].map({r: i for i, r in enumerate(reasons or [])}).fillna(len(reasons or []))
+    return exclusions.assign(_rank=rank, _stimulus=exclusions['stimulus'].map(stimulus_order))\
+        .sort_values(['_rank', 'id', '_stimulus'], kind='stable')\
+        .drop(['_rank', '_stimulus'], axis=1)
+
+
+def merge_file(base_dir, filename, order=None, overwrite=False, stream=False):
+    """
+    Merges a file of all shards into base_dir. Without overwrite, existing files are kept, as they might have been
+    edited by hand (exclusion files). With stream, the files have to be sorted by id and are merged without reading
+    them into memory (see merge_sorted_csv).
+    """
+    output_path = os.path.join(base_dir, filename)
+    if os.path.isfile(output_path) and not overwrite:
+        print(f'{output_path} already exists, not merging the shards into it')
+        return None
+
+    paths = shard_files(base_dir, filename)
+    if len(paths) == 0:
+        return None
+
+    print(f'Merging {len(paths)} shards into {output_path}')
+    if stream:
+        return merge_sorted_csv(paths, output_path)
+    return merge_csv(paths, output_path, order)
@@ -0,0 +1,210 @@
+"""
+Throughput telemetry of the long-running stages (transcode, ICatcher, OWLET): frames per second per trial and per
+stage, transcode speed, failures and the ETA of the job queue. The rates of successful trials also feed the job cost
+model (see cost_model.py).
+
+Everything is emitted as structured (JSON) log lines, one per finished trial and a summary every TELEMETRY_INTERVAL
+seconds, and as a Prometheus textfile per process in TELEMETRY_DIR that the textfile collector of a node exporter can
+scrape (node_exporter --collector.textfile.directory=output/telemetry).
+"""
+
+import os
+import json
+import time
+import socket
+import atexit
+import threading
+from contextlib import contextmanager
+
+import settings
+from . import cost_model
+
+
+class TrialCounter:
+    """Progress of a single trial, updated by the stage while it runs"""
+
+    def __init__(self, stage, participant, stimulus):
+        self.stage = stage
+        self.participant = participant
+        self.stimulus = stimulus
+        self.start = time.time()
+        self.frames = 0
+        self.media_seconds = 0.0
+
+    def add_frames(self, n=1):
+        self.frames += n
+
+    def add_media_seconds(self, seconds):
+        self.media_seconds += seconds
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def fps(self):
+        elapsed = self.elapsed()
+        return self.frames / elapsed if elapsed > 0 else 0.0
+
+
+class Telemetry:
+
+    def __init__(self):
+        self.worker = f'{socket.gethostname()}:{os.getpid()}'
+        self.lock = threading.Lock()
+        # stage -> totals of the finished trials
+        self.stages = dict()
+        self.active = []
+        self.queue_counts = None
+        self.queue_eta = None
+        self.queue_start = None  # (time, number of finished jobs) when this process first saw the queue
+        self.thread = None
+
+    def _stage(self, stage):
+        if stage not in self.stages:
+            self.stages[stage] = {'trials': 0, 'frames': 0, 'seconds': 0.0, 'media_seconds': 0.0, 'failures': 0}
+        return self.stages[stage]
+
+    def _start(self):
+        if self.thread is not None or not settings.TELEMETRY_INTERVAL:
+            return
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self._shutdown)
+
+    def _run(self):
+        while True:
+            time.sleep(settings.TELEMETRY_INTERVAL)
+            self.emit()
+
+    def _shutdown(self):
+        self.emit()
+        path = self._textfile_path()
+        if path and os.path.isfile(path):
+            os.remove(path)
+
+    @contextmanager
+    def trial(self, stage, participant, stimulus):
+        """
+        Times a trial of a stage, the stage reports its progress to the yielded TrialCounter. Only successful trials
+        count towards the totals and the job cost model, a trial that raises counts as a failure of its stage.
+        """
+        self._start()
+        counter = TrialCounter(stage, participant, stimulus)
+        with self.lock:
+            self.active.append(counter)
+        try:
+            yield counter
+        except Exception:
+            self.failure(stage)
+            raise
+        finally:
+            with self.lock:
+                self.active.remove(counter)
+
+        with self.lock:
+            totals = self._stage(stage)
+            totals['trials'] += 1
+            totals['frames'] += counter.frames
+            totals['seconds'] += counter.elapsed()
+            totals['media_seconds'] += counter.media_seconds
+
+        self._log('trial', stage=stage, participant=participant, stimulus=stimulus, frames=counter.frames,
+                  seconds=round(counter.elapsed(), 3), fps=round(counter.fps(), 2),
+                  **({'speed': round(counter.media_seconds / counter.elapsed(), 2)}
+                     if counter.media_seconds and counter.elapsed() > 0 else {}))
+        cost_model.get().record(stage, counter.frames, counter.elapsed())
+
+    def failure(self, stage):
+        self._start()
+        with self.lock:
+            self._stage(stage)['failures'] += 1
+
+    def queue(self, counts):
+        """Updates the number of jobs per status, the ETA extrapolates the rate at which all workers finish jobs"""
+        self._start()
+        finished = counts.get('done', 0) + counts.get('failed', 0)
+        remaining = counts.get('pending', 0) + counts.get('running', 0)
+        now = time.time()
+        with self.lock:
+            if self.queue_start is None:
+                self.queue_start = (now, finished)
+            start_time, start_finished = self.queue_start
+            rate = (finished - start_finished) / (now - start_time) if now > start_time else 0.0
+            self.queue_counts = counts
+            self.queue_eta = remaining / rate if rate > 0 else None
+
+    def snapshot(self):
+        with self.lock:
+            stages = {stage: dict(totals, fps=totals['frames'] / totals['seconds'] if totals['seconds'] > 0 else 0.0,
+                                  speed=totals['media_seconds'] / totals['seconds'] if totals['seconds'] > 0 else 0.0)
+                      for stage, totals in self.stages.items()}
+            active = [{'stage': c.stage, 'participant': c.participant, 'stimulus': c.stimulus, 'frames': c.frames,
+                       'fps': c.fps()} for c in self.active]
+            return {'stages': stages, 'active': active, 'queue': self.queue_counts, 'queue_eta': self.queue_eta}
+
+    def _log(self, event, **fields):
+        print(json.dumps({'event': f'telemetry.{event}', 'time': round(time.time(), 3), 'worker': self.worker,
+                          **fields}), flush=True)
+
+    def emit(self):
+        """Logs a summary line and rewrites the Prometheus textfile"""
+        snapshot = self.snapshot()
+        self._log('summary', **snapshot)
+        self._write_textfile(snapshot)
+
+    def _textfile_path(self):
+        if not settings.TELEMETRY_DIR:
+            return None
+        name = self.worker.replace(':', '_').replace('.', '_')
+        return os.path.join(settings.TELEMETRY_DIR, f'gazecoders_{name}.prom')
+
+    def _write_textfile(self, snapshot):
+        path = self._textfile_path()
+        if path is None:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        def labels(**values):
+            return '{' + ','.join(f'{k}="{v}"' for k, v in dict(worker=self.worker, **values).items()) + '}'
+
+        metrics = [
+            ('trials_total', 'counter', 'Finished trials', 'trials'),
+            ('frames_total', 'counter', 'Frames processed in finished trials', 'frames'),
+            ('seconds_total', 'counter', 'Wall-clock seconds spent on finished trials', 'seconds'),
+            ('failures_total', 'counter', 'Failed trials and calibrations', 'failures'),
+            ('frames_per_second', 'gauge', 'Average frames per second of the finished trials', 'fps'),
+            ('media_speed', 'gauge', 'Seconds of video transcoded per wall-clock second', 'speed'),
+        ]
+        lines = []
+        for name, kind, description, key in metrics:
+            lines += [f'# HELP gazecoders_stage_{name} {description}', f'# TYPE gazecoders_stage_{name} {kind}']
+            lines += [f'gazecoders_stage_{name}{labels(stage=stage)} {totals[key]}'
+                      for stage, totals in snapshot['stages'].items()]
+
+        lines += ['# HELP gazecoders_trial_frames_per_second Frames per second of the running trials',
+                  '# TYPE gazecoders_trial_frames_per_second gauge']
+        lines += [f'gazecoders_trial_frames_per_second'
+                  f'{labels(stage=a["stage"], participant=a["participant"], stimulus=a["stimulus"])} {a["fps"]}'
+                  for a in snapshot['active']]
+
+        if snapshot['queue'] is not None:
+            lines += ['# HELP gazecoders_queue_jobs Jobs in the job queue per status',
+                      '# TYPE gazecoders_queue_jobs gauge']
+            lines += [f'gazecoders_queue_jobs{labels(status=status)} {count}'
+                      for status, count in snapshot['queue'].items()]
+            if snapshot['queue_eta'] is not None:
+                lines += ['# HELP gazecoders_queue_eta_seconds Estimated seconds until the job queue is drained',
+                          '# TYPE gazecoders_queue_eta_seconds gauge',
+                          f'gazecoders_queue_eta_seconds{labels()} {snapshot["queue_eta"]}']
+
+        # the collector must never see a partially written file
+        with open(f'{path}.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(f'{path}.tmp', path)
+
+
+_telemetry = Telemetry()
+
+trial = _telemetry.trial
+failure = _telemetry.failure
+queue = _telemetry.queue
+emit = _telemetry.emit
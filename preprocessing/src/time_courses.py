@@ -0,0 +1,115 @@
+import warnings
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+import settings
+from .gaze_cube import GazeCube
+
+
+def bootstrap_time_course(values, n_boot, seed, ci=0.95):
+    """
+    Computes the proportion of target looking per time bin and a percentile bootstrap confidence interval
+    over the rows of values (one row per trial, one column per time bin, 1.0 = target, 0.0 = distractor,
+    NaN = neither). Rows that are NaN throughout are ignored.
+
+    Instead of materializing every resampled data set, each bootstrap replicate is expressed as a vector of
+    multinomial row counts, so that all replicates of all time bins come out of two matrix products.
+    """
+    # rows without any data (participants who did not see the stimulus or whose trial was excluded) are no trials,
+    # resampling them would make the number of trials per replicate random
+    values = values[~np.isnan(values).all(axis=1)]
+    n_rows = values.shape[0]
+    valid = ~np.isnan(values)
+    hits = np.where(valid, values, 0.0)
+    if n_rows == 0:
+        nan = np.full(values.shape[1], np.nan)
+        return valid.sum(axis=0), nan, nan, nan
+
+    rng = np.random.default_rng(seed)
+    weights = rng.multinomial(n_rows, np.full(n_rows, 1.0 / n_rows), size=n_boot).astype(np.float64)
+
+    with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        prop = hits.sum(axis=0) / valid.sum(axis=0)
+        boot = (weights @ hits) / (weights @ valid)
+        lower, upper = np.nanquantile(boot, [(1 - ci) / 2, 1 - (1 - ci) / 2], axis=0)
+
+    return valid.sum(axis=0), prop, lower, upper
+
+
+def _bootstrap_task(task):
+    group_col, label, measure, t, values, n_boot, seed, ci = task
+    n, prop, lower, upper = bootstrap_time_course(values, n_boot, seed, ci)
+
+    table = pd.DataFrame({'measure': measure, group_col: label, 't': t,
+                          'n': n, 'prop_target': prop, 'ci_lower': lower, 'ci_upper': upper})
+    # drop the time bins after the end of the stimulus
+    return group_col, table[table['n'] > 0]
+
+
+def _trial_positions(cube):
+    """Trial position of every (participant, stimulus), one participant at a time for memory-mapped cubes"""
+    positions = np.full((len(cube.participants), len(cube.stimuli)), np.nan, dtype=np.float32)
+    with warnings.catch_warnings():
+        # trials without data stay NaN
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        for i in range(len(cube.participants)):
+            positions[i] = np.nanmax(np.asarray(cube.arrays['trial'][i]), axis=-1)
+    return positions
+
+
+def _tasks(cube, n_boot, ci):
+    """The bootstrap tasks of all groups, the values of a task are only read from the cube once it gets submitted"""
+    seed = settings.TIME_COURSE_SEED
+    trial_positions = _trial_positions(cube) if 'trial' in cube.measures else None
+    for measure in [m for m in GazeCube.HIT_MEASURES if m in cube.measures]:
+        for s in cube.stimuli:
+            values = cube.window(measure, stimuli=[s])[:, 0, :]
+            yield 'stimulus', s, measure, cube.t, values, n_boot, seed, ci
+            seed += 1
+
+        if trial_positions is not None:
+            for trial in np.unique(trial_positions[~np.isnan(trial_positions)]):
+                p_idx, s_idx = np.nonzero(trial_positions == trial)
+                values = cube.arrays[measure][p_idx, s_idx, :]
+                yield 'trial', int(trial), measure, cube.t, values, n_boot, seed, ci
+                seed += 1
+
+
+def _bounded_map(executor, function, tasks, window):
+    """Like executor.map, but only takes the next task once fewer than window results are pending"""
+    pending = deque()
+    for task in tasks:
+        pending.append(executor.submit(function, task))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def compute_time_courses(cube, executor=None, window=None):
+    """
+    Returns two tables with the proportion of target looking per time bin for every hit measure of the cube,
+    one grouped by stimulus and one grouped by trial position (across the stimuli presented at that position).
+    The bootstrap of the individual groups gets spread over the executor if one is passed, with at most window tasks
+    pending at a time (all of them if None).
+    """
+    tasks = _tasks(cube, settings.TIME_COURSE_BOOTSTRAP_SAMPLES, settings.TIME_COURSE_CI)
+    if executor:
+        results = _bounded_map(executor, _bootstrap_task, tasks, window) if window else executor.map(_bootstrap_task, tasks)
+    else:
+        results = map(_bootstrap_task, tasks)
+
+    tables = {'stimulus': [], 'trial': []}
+    for group_col, table in results:
+        tables[group_col].append(table)
+
+    return {group_col: pd.concat(group_tables).reset_index(drop=True) if len(group_tables) > 0 else pd.DataFrame()
+            for group_col, group_tables in tables.items()}
+
+
+def save_time_courses(time_courses, name, out_dir):
+    for group_col, table in time_courses.items():
+        table.to_csv(f'{out_dir}/{name}_timecourse_{group_col}.csv', encoding='utf-8', index=False)
@@ -1,10 +1,10 @@
 import os
-import json
 
 import pandas as pd
 
 import settings
 from .base_xy_handler import EyetrackingHandler
+from .participant_index import ParticipantDataIndex
 
 
 class WebGazerHandler(EyetrackingHandler):
@@ -13,115 +13,134 @@ class WebGazerHandler(EyetrackingHandler):
         super().__init__(name, participants, general_exclusions, dot_color)
         self.data_validation = None
 
+    def _get_trial_aggregations(self):
+        return {**super()._get_trial_aggregations(), 'sampling_rate': ('sampling_rate', 'min')}
+
     def _get_exclusion_functions(self):
         parent_functions = super()._get_exclusion_functions()
 
-        def exclude_no_tracking_data(data):
-            exclude_tracking = data[data.apply(lambda r: not os.path.isfile(f'{settings.DATA_DIR}/{r["id"]}_data.json'), axis=1)][
-                ['id', 'stimulus']].drop_duplicates(keep='first').reset_index(drop=True)
-            return exclude_tracking
+        def exclude_no_tracking_data(trials):
+            # one filesystem check per participant
+            has_data_file = {p: os.path.isfile(f'{settings.DATA_DIR}/{p}_data.json') for p in trials['id'].unique()}
+            return ~trials['id'].map(has_data_file).astype(bool)
 
-        def exclude_samplingrate(data):
-            exclude_sampling = data[data['sampling_rate'] < settings.WEBGAZER_SAMPLING_CUTOFF][
-                ['id', 'stimulus']].drop_duplicates(keep='first').reset_index(drop=True)
-            return exclude_sampling
+        def exclude_samplingrate(trials):
+            return trials['sampling_rate'] < settings.WEBGAZER_SAMPLING_CUTOFF
 
         return parent_functions + [(exclude_no_tracking_data, '_no_tracking_data_wg'), (exclude_samplingrate, '_low_sampling_wg')]
 
-    def _preprocess(self):
-        df_dict_list = []
-        df_dict_list_validation = []
-        for p in self.participants:
+    def _cache_params(self, participant):
+        return super()._cache_params(participant) + [self._validation_usable(participant)]
 
-            data_file = f'{settings.DATA_DIR}/{p}_data.json'
-            if not os.path.isfile(data_file):
-                continue
+    def _preprocess(self):
+        source_files = lambda p: [f for f in [f'{settings.DATA_DIR}/{p}_data.json'] if os.path.isfile(f)]
+        validation = []
+
+        def split_validation(results):
+            # the validation data is small and stays in memory, the gaze data goes to _store_data
+            for data, data_validation in results:
+                validation.append(data_validation)
+                yield data
+
+        if settings.WEBGAZER_WORKERS == 1:
+            self._store_data(split_validation(self._iter_participant_data(source_files, self._preprocess_participant)))
+        else:
+            # participants are independent; results come back in participant order, just like the serial path
+            with self._participant_process_pool(settings.WEBGAZER_WORKERS) as executor:
+                self._store_data(split_validation(self._iter_participant_data(
+                    source_files, self._in_worker('_preprocess_participant'), executor, settings.WEBGAZER_WORKERS)))
+
+        self.data_validation = pd.concat(validation)\
+            .sort_values(['id', 'index'])\
+            .reset_index(drop=True)
 
-            with open(data_file) as f:
-                data = json.load(f)
+        self.backfill_cols += ['trial', 'sampling_rate']
 
-            self._append_validation_data(df_dict_list_validation, data, p)
+    def _preprocess_participant(self, p):
+        df_dict_list = []
+        df_dict_list_validation = []
 
-            data = [x for x in data if 'task' in x and x['task'] == 'video']
+        participant_index = ParticipantDataIndex(p)
 
-            p_out_dir = f'{settings.DATA_DIR}/{p}'
-            if not os.path.exists(p_out_dir):
-                os.makedirs(p_out_dir)
+        self._append_validation_data(df_dict_list_validation, participant_index, p)
 
-            df_dict = dict()
-            df_dict['id'] = p
+        data = participant_index.video_trials()
 
-            for index, trial in enumerate(data):
+        p_out_dir = f'{settings.DATA_DIR}/{p}'
+        if not os.path.exists(p_out_dir):
+            os.makedirs(p_out_dir)
 
-                df_dict['trial'] = index + 1
-                df_dict['stimulus'] = trial['stimulus'][0].split("/")[-1].split(".")[0]
+        df_dict = dict()
+        df_dict['id'] = p
 
-                if not self._should_process_trial(p, df_dict['stimulus']):
-                    continue
+        for index, trial in enumerate(data):
 
-                # calculate sampling rate
-                datapoints = trial['webgazer_data']
-                sampling_diffs = [datapoints[i + 1]['t'] - datapoints[i]['t'] for i in range(1, len(datapoints) - 1)]
-                sampling_rates = [1000 / diff for diff in sampling_diffs]
+            df_dict['trial'] = index + 1
+            df_dict['stimulus'] = trial['stimulus'][0].split("/")[-1].split(".")[0]
 
-                df_dict['sampling_rate'] = sum(sampling_rates) / len(sampling_rates)
+            if not self._should_process_trial(p, df_dict['stimulus']):
+                continue
 
-                for datapoint in datapoints:
+            # calculate sampling rate
+            datapoints = trial['webgazer_data']
+            sampling_diffs = [datapoints[i + 1]['t'] - datapoints[i]['t'] for i in range(1, len(datapoints) - 1)]
+            sampling_rates = [1000 / diff for diff in sampling_diffs]
 
-                    df_dict['t'] = datapoint["t"]
-                    x_stim, y_stim, outside = self._translate_coordinates(settings.STIMULI[df_dict['stimulus']]['width'] / settings.STIMULI[df_dict['stimulus']]['height'],
-                                                                          trial['windowHeight'],
-                                                                          trial['windowWidth'],
-                                                                          settings.STIMULI[df_dict['stimulus']]['height'],
-                                                                          settings.STIMULI[df_dict['stimulus']]['width'],
-                                                                          datapoint["x"],
-                                                                          datapoint["y"]
-                                                                          )
+            df_dict['sampling_rate'] = sum(sampling_rates) / len(sampling_rates)
 
-                    df_dict['x'] = x_stim
-                    df_dict['y'] = y_stim
-                    df_dict['outside'] = outside
+            for datapoint in datapoints:
 
-                    df_dict['aoi'] = 'none'
-                    if "hitAois" in datapoint:
-                        hit_aoi_string = ','.join(datapoint['hitAois'])
-                        df_dict['aoi'] = 'left' if 'left' in hit_aoi_string else ('right' if 'right' in hit_aoi_string else 'none')
+                df_dict['t'] = datapoint["t"]
+                x_stim, y_stim, outside = self._translate_coordinates(settings.STIMULI[df_dict['stimulus']]['width'] / settings.STIMULI[df_dict['stimulus']]['height'],
+                                                                      trial['windowHeight'],
+                                                                      trial['windowWidth'],
+                                                                      settings.STIMULI[df_dict['stimulus']]['height'],
+                                                                      settings.STIMULI[df_dict['stimulus']]['width'],
+                                                                      datapoint["x"],
+                                                                      datapoint["y"]
+                                                                      )
 
-                    df_dict['side'] = 'left' if x_stim < settings.STIMULI[df_dict['stimulus']]['width'] / 2.0 else 'right'
+                df_dict['x'] = x_stim
+                df_dict['y'] = y_stim
+                df_dict['outside'] = outside
 
-                    df_dict_list.append(dict(df_dict))
+                df_dict['aoi'] = 'none'
+                if "hitAois" in datapoint:
+                    hit_aoi_string = ','.join(datapoint['hitAois'])
+                    df_dict['aoi'] = 'left' if 'left' in hit_aoi_string else ('right' if 'right' in hit_aoi_string else 'none')
 
-        self.data_validation = pd.DataFrame(df_dict_list_validation)\
-            .sort_values(['id', 'index'])\
-            .reset_index(drop=True)
+                df_dict['side'] = 'left' if x_stim < settings.STIMULI[df_dict['stimulus']]['width'] / 2.0 else 'right'
 
-        self.data = pd.DataFrame(df_dict_list)\
-            .sort_values(['id', 'trial', 't'])\
-            .reset_index(drop=True)
+                df_dict_list.append(dict(df_dict))
 
-        self.data['aoi_hit'] = self._side_to_hit(self.data['stimulus'], self.data['aoi'])
-        self.data['side_hit'] = self._side_to_hit(self.data['stimulus'], self.data['side'])
+        data = pd.DataFrame(df_dict_list)
+        if len(data.index) > 0:
+            data['aoi_hit'] = self._side_to_hit(data['stimulus'], data['aoi'])
+            data['side_hit'] = self._side_to_hit(data['stimulus'], data['side'])
 
-        self.backfill_cols += ['trial', 'sampling_rate']
+        return data, pd.DataFrame(df_dict_list_validation)
 
     def _save_data(self):
         super(WebGazerHandler, self)._save_data()
-        self.data_validation.to_csv(f'{settings.OUT_DIR}/{self.name}_validation.csv', encoding='utf-8', index=False)
+        self.data_validation.to_csv(f'{settings.RESULTS_DIR}/{self.name}_validation.csv', encoding='utf-8', index=False)
 
-    def _append_validation_data(self, df_dict_list, data, participant):
-        # a hacky addition to allow for simple analysis of jspsych webgazer validation trials
+    def _result_files(self):
+        return super()._result_files() + [f'{self.name}_validation.csv']
 
+    def _validation_usable(self, participant):
         # check if both validation trials were deemed usable
-        if len(self.general_exclusions[(self.general_exclusions['id'] == participant) &
-                                       (self.general_exclusions['excluded'] != 'x') &
-                                       ((self.general_exclusions['stimulus'] == 'validation1') | (self.general_exclusions['stimulus'] == 'validation2'))
-               ].reset_index(drop=True).index) != 2:
-            return
+        return len(self.general_exclusions[(self.general_exclusions['id'] == participant) &
+                                           (self.general_exclusions['excluded'] != 'x') &
+                                           ((self.general_exclusions['stimulus'] == 'validation1') | (self.general_exclusions['stimulus'] == 'validation2'))
+                   ].reset_index(drop=True).index) == 2
 
-        data_validation = [x for x in data if 'trial_type' in x and x['trial_type'] == 'webgazer-validate']
+    def _append_validation_data(self, df_dict_list, participant_index, participant):
+        # a hacky addition to allow for simple analysis of jspsych webgazer validation trials
+
+        if not self._validation_usable(participant):
+            return
 
-        # hacky way to get the window height and width, as the validation data does not contain that information
-        first_trial = [x for x in data if 'task' in x and x['task'] == 'video'][0]
+        data_validation = participant_index.validation_trials()
 
         df_dict = dict()
         df_dict['id'] = participant
@@ -131,10 +150,9 @@ class WebGazerHandler(EyetrackingHandler):
             df_dict['avg_offset_x'] = validation_trial['average_offset'][0]['x']
             df_dict['avg_offset_y'] = validation_trial['average_offset'][0]['y']
             df_dict['mean_distance'] = validation_trial['average_offset'][0]['r']
-            df_dict['window_width'] = first_trial[
-                "windowWidth"]  # assumes height stays constant across trials
-            df_dict['window_height'] = first_trial[
-                "windowHeight"]  # assumes height stays constant across trials
+            # hacky way to get the window height and width, as the validation data does not contain that information
+            df_dict['window_width'] = participant_index.window_width  # assumes width stays constant across trials
+            df_dict['window_height'] = participant_index.window_height  # assumes height stays constant across trials
             df_dict['avg_offset_x_percent'] = df_dict['avg_offset_x'] / df_dict[
                 'window_width'] * 100
             df_dict['avg_offset_y_percent'] = df_dict['avg_offset_y'] / df_dict[